@@ -0,0 +1,341 @@
+# Benchmarks of the engine and renderer hot paths, run with `python bench.py`.
+# Results are compared to bench_baseline.json (measured on the machine that
+# last saved it with --save) and the run fails when one is slower than the
+# baseline by more than --threshold.
+
+from argparse import ArgumentParser
+from json import dump, load
+from os.path import abspath, dirname
+from random import Random
+from subprocess import DEVNULL, PIPE
+from subprocess import run as run_process
+from sys import executable, stderr
+from timeit import Timer
+
+from tetris import (
+    Game,
+    Renderer,
+    garbage_code,
+    play_headless,
+    put_tetromino,
+    recorded_actions,
+)
+
+baseline_file = "bench_baseline.json"
+here = dirname(abspath(__file__))
+
+
+def game_for_bench():
+    game = Game(headless=True)
+    game.test = True
+    game.new_tetromino()
+    return game
+
+
+def dense_game(full_lines=4, height=16):
+    # A stack of `height` lines with a hole each, except the bottom ones
+    game = game_for_bench()
+    grid = list(game.grid)
+    for r in range(height):
+        hole = -1 if r < full_lines else (r * 3) % game.width
+        grid[r] = [0 if c == hole else garbage_code for c in range(game.width)]
+    return Game(grid, seed=0)
+
+
+class NullStream:
+    def write(self, data):
+        pass
+
+    def flush(self):
+        pass
+
+
+def bench_tetromino_fits(game):
+    fits = game.tetromino_fits
+    return lambda: fits("t", 4, 0, 2)
+
+
+def bench_tetromino_touches_ceiling(game):
+    touches_ceiling = game.tetromino_touches_ceiling
+    return lambda: touches_ceiling("l", 4, 18, 1)
+
+
+def bench_put_tetromino(game):
+    grid = game.grid
+    return lambda: put_tetromino(grid, "s", 4, 0, 0)
+
+
+def bench_rotate(game):
+    def rotate():
+        # rotating the i tetromino against the left wall needs a wall kick
+        game.current_shape = "i"
+        game.current_rotation = 3
+        game.current_column = -1
+        game.current_row = 10
+        game.rotate(1)
+
+    return rotate
+
+
+def bench_get_ghost_row(game):
+    def get_ghost_row():
+        # moving the tetromino invalidates the cached landing row
+        game.current_column ^= 1
+        game.get_ghost_row()
+
+    return get_ghost_row
+
+
+def bench_hard_drop(game):
+    state = game.snapshot()
+
+    def hard_drop():
+        game.restore(state)
+        game.hard_drop()
+
+    return hard_drop
+
+
+def bench_remove_complete_lines(game):
+    game = dense_game()
+    state = game.snapshot()
+
+    def remove_complete_lines():
+        game.restore(state)
+        game.remove_complete_lines(False, False, range(4))
+
+    return remove_complete_lines
+
+
+def bench_render_grid(game):
+    game = dense_game(0)
+    game.new_tetromino()
+    return game.render_grid
+
+
+def bench_render(game):
+    # A whole frame written by the differential renderer, the tetromino
+    # moving between frames
+    game = dense_game(0)
+    game.renderer = Renderer(NullStream())
+    game.new_tetromino()
+
+    def render():
+        game.current_column ^= 1
+        game.draw()
+
+    return render
+
+
+# Seeded games played by a policy, timed per piece
+game_seeds = range(4)
+game_max_pieces = 250
+
+
+def bench_random_games(game):
+    pieces = sum(
+        play_headless(seed, "random", game_max_pieces).pieces for seed in game_seeds
+    )
+
+    def random_games():
+        for seed in game_seeds:
+            play_headless(seed, "random", game_max_pieces)
+
+    return random_games, pieces
+
+
+# Random moves played in many games at once, timed per game and step, games
+# over restart with the same seed
+batch_games = 1024
+batch_steps = 50
+batch_actions = [
+    [Random(step).choice(recorded_actions[:7]) for game in range(batch_games)]
+    for step in range(batch_steps)
+]
+
+
+def bench_game_steps(game):
+    def game_steps():
+        games = [Game(headless=True, seed=seed) for seed in range(batch_games)]
+        for actions in batch_actions:
+            for seed, action in enumerate(actions):
+                if games[seed].game_over:
+                    games[seed] = Game(headless=True, seed=seed)
+                games[seed].step(action)
+
+    return game_steps, batch_games * batch_steps
+
+
+def bench_vector_steps(game):
+    try:
+        import numpy as np
+
+        from vector import VectorGame
+    except ImportError:
+        return None
+    actions = np.array(
+        [[recorded_actions.index(action) for action in row] for row in batch_actions]
+    )
+
+    def vector_steps():
+        games = VectorGame(range(batch_games))
+        for step_actions in actions:
+            over = np.flatnonzero(games.game_over)
+            if len(over):
+                games.reset(over, over)
+            games.step(step_actions)
+
+    return vector_steps, batch_games * batch_steps
+
+
+# Cold processes, timed from the interpreter start
+first_frame_code = """
+from os import devnull
+from tetris import Game, Renderer
+game = Game(seed=0)
+game.renderer = Renderer(open(devnull, "w"))
+game.new_tetromino()
+game.draw()
+"""
+
+
+def cold_process(*args):
+    return run_process(
+        [executable, *args], cwd=here, stdout=DEVNULL, stderr=PIPE, check=True
+    )
+
+
+def bench_startup_import(game):
+    return lambda: cold_process("-c", "import tetris")
+
+
+def bench_startup_first_frame(game):
+    return lambda: cold_process("-c", first_frame_code)
+
+
+def import_times(module="tetris"):
+    # Cumulative import times in seconds of the modules imported by a cold
+    # `import module`, as reported by -X importtime, slowest first
+    output = cold_process("-X", "importtime", "-c", "import " + module).stderr
+    times = {}
+    for line in output.decode().splitlines()[1:]:
+        _, cumulative, name = line.split("|")
+        times[name.strip()] = int(cumulative) / 1e6
+    return sorted(times.items(), key=lambda item: -item[1])
+
+
+benchmarks = {
+    "tetromino_fits": bench_tetromino_fits,
+    "tetromino_touches_ceiling": bench_tetromino_touches_ceiling,
+    "put_tetromino": bench_put_tetromino,
+    "rotate": bench_rotate,
+    "get_ghost_row": bench_get_ghost_row,
+    "hard_drop": bench_hard_drop,
+    "remove_complete_lines": bench_remove_complete_lines,
+    "render_grid": bench_render_grid,
+    "render": bench_render,
+    "random_games": bench_random_games,
+    "game_steps": bench_game_steps,
+    "vector_steps": bench_vector_steps,
+    "startup_import": bench_startup_import,
+    "startup_first_frame": bench_startup_first_frame,
+}
+
+
+def run(names=None, repeat=5):
+    # Seconds per call, or per piece for the games and per game and step for
+    # the batches, benchmarks of missing optional modules are skipped
+    results = {}
+    for name, setup in benchmarks.items():
+        if names and name not in names:
+            continue
+        function = setup(game_for_bench())
+        if function is None:
+            continue
+        count = 1
+        if isinstance(function, tuple):
+            function, count = function
+        timer = Timer(function)
+        number, _ = timer.autorange()
+        best = min(timer.repeat(repeat, number)) / number
+        results[name] = best / count
+    return results
+
+
+def compare(results, baseline, threshold):
+    # Returns the names of the benchmarks slower than the baseline by more
+    # than the threshold
+    return [
+        name
+        for name, seconds in results.items()
+        if name in baseline and seconds > baseline[name] * (1 + threshold)
+    ]
+
+
+def main(args=None):
+    parser = ArgumentParser(description="Benchmarks of tetris.py")
+    parser.add_argument("names", nargs="*", help="benchmarks to run, all by default")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--baseline", default=baseline_file)
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.25,
+        help="slowdown ratio over the baseline that fails the run",
+    )
+    parser.add_argument(
+        "--save", action="store_true", help="save the results as the baseline"
+    )
+    parser.add_argument(
+        "--importtime",
+        action="store_true",
+        help="show the slowest modules imported by tetris.py instead",
+    )
+    args = parser.parse_args(args)
+    if args.importtime:
+        for name, seconds in import_times()[:20]:
+            print("{:<32}{:>10.0f} us".format(name, seconds * 1e6))
+        return 0
+    unknown = set(args.names) - set(benchmarks)
+    if unknown:
+        parser.error("unknown benchmarks: " + ", ".join(sorted(unknown)))
+    results = run(args.names, args.repeat)
+    try:
+        with open(args.baseline) as file:
+            baseline = load(file)
+    except FileNotFoundError:
+        baseline = {}
+    for name, seconds in results.items():
+        line = "{:<32}{:>10.0f} ns/call".format(name, seconds * 1e9)
+        if name == "random_games":
+            line = "{:<32}{:>10.0f} pieces/s".format(name, 1 / seconds)
+        elif name.startswith("startup_"):
+            line = "{:<32}{:>10.1f} ms".format(name, seconds * 1e3)
+        if name in baseline:
+            line += "  {:+6.1%}".format(seconds / baseline[name] - 1)
+        print(line)
+    if "game_steps" in results and "vector_steps" in results:
+        speedup = results["game_steps"] / results["vector_steps"]
+        print("vector_steps is {:.1f}x faster than game_steps".format(speedup))
+    if args.save:
+        with open(args.baseline, "w") as file:
+            baseline.update(
+                (name, float("{:.4g}".format(seconds)))
+                for name, seconds in results.items()
+            )
+            dump(baseline, file, indent=2, sort_keys=True)
+            file.write("\n")
+        return 0
+    regressions = compare(results, baseline, args.threshold)
+    if regressions:
+        print(
+            "slower than the baseline by more than {:.0%}:".format(args.threshold),
+            *regressions,
+            file=stderr,
+        )
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
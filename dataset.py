@@ -0,0 +1,230 @@
+# Training data exported from headless games to chunked .npy files, needs
+# numpy.
+#
+# Each placement is a sample: the grid when the tetromino spawned, the current
+# and next shapes, the column and rotation it locked at, and the score and
+# lines it earned. Boards are stored bottom row first as piece codes, or with
+# bitplanes as one bit per cell packed with np.packbits along the rows.
+#
+# Samples are appended to memory-mapped chunks preallocated for chunk_size
+# rows, so the writer only maps one chunk of each array at a time whatever the
+# number of samples. The games chunks index the first sample, the number of
+# samples, the seed and the outcome of each game. Readers map the chunks
+# read-only and get views of them without copying.
+
+from contextlib import closing
+from json import dump, load
+from os import makedirs, replace
+from os.path import join
+from time import perf_counter
+
+import numpy as np
+from numpy.lib.format import open_memmap
+
+from tetris import BatchStats, piece_codes, play_headless
+
+sample_dtype = np.dtype(
+    [
+        ("shape", "u1"),
+        ("next_shape", "u1"),
+        ("column", "i1"),
+        ("rotation", "u1"),
+        ("reward", "i4"),
+        ("lines", "u1"),
+    ]
+)
+game_dtype = np.dtype(
+    [
+        ("seed", "u8"),
+        ("start", "u8"),
+        ("samples", "u4"),
+        ("score", "u4"),
+        ("lines", "u4"),
+    ]
+)
+
+metadata_file = "dataset.json"
+
+
+def chunk_path(directory, name, index):
+    return join(directory, "{}-{:05}.npy".format(name, index))
+
+
+# Appends rows to preallocated memory-mapped chunks of chunk_size rows, the
+# last one is shrunk to the rows written when closed.
+class ChunkWriter:
+    def __init__(self, directory, name, dtype, shape=(), chunk_size=65536):
+        self.directory = directory
+        self.name = name
+        self.dtype = dtype
+        self.shape = shape
+        self.chunk_size = chunk_size
+        self.chunk = None
+        self.chunks = 0
+        self.position = 0
+        self.rows = 0
+
+    def append(self, row):
+        if self.chunk is None:
+            self.chunk = open_memmap(
+                chunk_path(self.directory, self.name, self.chunks),
+                mode="w+",
+                dtype=self.dtype,
+                shape=(self.chunk_size, *self.shape),
+            )
+            self.chunks += 1
+        self.chunk[self.position] = row
+        self.position += 1
+        self.rows += 1
+        if self.position == self.chunk_size:
+            self.chunk.flush()
+            self.chunk = None
+            self.position = 0
+
+    def close(self):
+        if self.chunk is None:
+            return
+        path = chunk_path(self.directory, self.name, self.chunks - 1)
+        rows = self.chunk[: self.position]
+        last = open_memmap(path + ".tmp", mode="w+", dtype=self.dtype, shape=rows.shape)
+        last[:] = rows
+        last.flush()
+        del last
+        self.chunk = None
+        replace(path + ".tmp", path)
+
+
+class DatasetWriter:
+    def __init__(
+        self, directory, width=10, height=40, chunk_size=65536, bitplanes=False
+    ):
+        makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.width = width
+        self.height = height
+        self.chunk_size = chunk_size
+        self.bitplanes = bitplanes
+        board_shape = (height, (width + 7) // 8 if bitplanes else width)
+        self.boards = ChunkWriter(directory, "boards", "u1", board_shape, chunk_size)
+        self.samples = ChunkWriter(directory, "samples", sample_dtype, (), chunk_size)
+        self.games = ChunkWriter(directory, "games", game_dtype, (), chunk_size)
+        self.game_start = 0
+
+    def add(self, grid, shape, next_shape, column, rotation, reward, lines):
+        # The grid lines are bytes of piece codes, joined they are the board
+        board = np.frombuffer(b"".join(grid), "u1").reshape(self.height, self.width)
+        if self.bitplanes:
+            board = np.packbits(board, axis=1)
+        self.boards.append(board)
+        self.samples.append(
+            (
+                piece_codes[shape],
+                piece_codes[next_shape],
+                column,
+                rotation,
+                reward,
+                lines,
+            )
+        )
+
+    def end_game(self, summary):
+        samples = self.samples.rows - self.game_start
+        self.games.append(
+            (summary.seed, self.game_start, samples, summary.score, summary.lines)
+        )
+        self.game_start = self.samples.rows
+
+    def close(self):
+        for writer in (self.boards, self.samples, self.games):
+            writer.close()
+        with open(join(self.directory, metadata_file), "w") as file:
+            dump(
+                {
+                    "width": self.width,
+                    "height": self.height,
+                    "chunk_size": self.chunk_size,
+                    "bitplanes": self.bitplanes,
+                    "samples": self.samples.rows,
+                    "games": self.games.rows,
+                },
+                file,
+                indent=2,
+            )
+            file.write("\n")
+
+
+class Dataset:
+    def __init__(self, directory):
+        with open(join(directory, metadata_file)) as file:
+            metadata = load(file)
+        self.width = metadata["width"]
+        self.height = metadata["height"]
+        self.chunk_size = metadata["chunk_size"]
+        self.bitplanes = metadata["bitplanes"]
+        self.boards = self.load_chunks(directory, "boards", metadata["samples"])
+        self.samples = self.load_chunks(directory, "samples", metadata["samples"])
+        games = self.load_chunks(directory, "games", metadata["games"])
+        if len(games) == 1:
+            self.games = games[0]
+        else:
+            self.games = np.concatenate(games or [np.empty(0, game_dtype)])
+
+    def load_chunks(self, directory, name, rows):
+        return [
+            np.load(chunk_path(directory, name, index), mmap_mode="r")
+            for index in range(-(-rows // self.chunk_size))
+        ]
+
+    def __len__(self):
+        return sum(len(chunk) for chunk in self.samples)
+
+    def chunks(self):
+        # Yields the boards and samples of each chunk
+        return zip(self.boards, self.samples)
+
+    def rows(self, chunks, start, stop):
+        # Rows start to stop of chunked arrays, only copied when they span
+        # several chunks
+        first, start = divmod(start, self.chunk_size)
+        last, stop = divmod(stop - 1, self.chunk_size)
+        if first == last:
+            return chunks[first][start : stop + 1]
+        return np.concatenate(
+            [
+                chunks[first][start:],
+                *chunks[first + 1 : last],
+                chunks[last][: stop + 1],
+            ]
+        )
+
+    def game(self, index):
+        # The boards and samples of a game
+        start = int(self.games[index]["start"])
+        stop = start + int(self.games[index]["samples"])
+        if start == stop:
+            board_shape = (
+                self.height,
+                (self.width + 7) // 8 if self.bitplanes else self.width,
+            )
+            return np.empty((0, *board_shape), "u1"), np.empty(0, sample_dtype)
+        return self.rows(self.boards, start, stop), self.rows(self.samples, start, stop)
+
+    def unpack(self, boards):
+        # Boards as one byte per cell, 0 when empty
+        if not self.bitplanes:
+            return boards
+        return np.unpackbits(boards, axis=-1, count=self.width)
+
+
+def export_command(args):
+    stats = BatchStats()
+    start = perf_counter()
+    writer = DatasetWriter(
+        args.directory, chunk_size=args.chunk_size, bitplanes=args.bitplanes
+    )
+    with closing(writer):
+        for game_seed in range(args.seed, args.seed + args.games):
+            stats.add(play_headless(game_seed, args.policy, args.max_pieces, writer))
+    if stats.games:
+        print(stats.report(perf_counter() - start))
+    print("{} samples written to {}".format(writer.samples.rows, args.directory))
@@ -0,0 +1,655 @@
+# Multiplayer server hosting many games in one asyncio event loop.
+#
+# A client sends one mode byte (solo or versus) then one byte per action, the
+# index of the action in recorded_actions. The server answers with messages
+# made of a type byte, a 2 bytes payload length and the payload. Frames hold
+# the game state and the piece codes of the visible cells (the lines of the
+# grid as they are), bottom row first, so no ANSI frame is ever built on the
+# server. The gravity of all the games is driven by one GravityWheel task.
+#
+# Spectators send the watch mode byte and the 4 bytes id of a game. They get
+# a frame then deltas holding the state and only the cells changed since the
+# previous frame, encoded once and shared by all the spectators of the game.
+
+from asyncio import (
+    IncompleteReadError,
+    TimeoutError,
+    create_task,
+    gather,
+    open_connection,
+    run,
+    sleep,
+    start_server,
+    wait_for,
+)
+from random import Random, randrange
+from struct import Struct
+from sys import stderr, stdin
+from time import perf_counter
+
+from tetris import (
+    Game,
+    GravityWheel,
+    Keyboard,
+    RenderScheduler,
+    piece_codes,
+    recorded_actions,
+    row_mask,
+    shapes,
+    show_cursor,
+)
+
+SOLO = b"S"
+VERSUS = b"V"
+WATCH = b"W"
+
+HELLO = 0
+WAITING = 1
+FRAME = 2
+GAME_OVER = 3
+DELTA = 4
+
+header = Struct(">BH")
+# width, visible height, seed, game id
+hello = Struct(">BBII")
+# score, level, lines, next shape, current shape, column, row, rotation,
+# pending garbage lines
+frame_header = Struct(">IHHBBbbBB")
+# score, won
+game_over = Struct(">IB")
+# index and code of a cell changed by a delta
+changed_cell = Struct(">HB")
+game_id = Struct(">I")
+
+shape_codes = {None: 0, **piece_codes}
+action_codes = {action: code for code, action in enumerate(recorded_actions)}
+
+# Garbage lines sent to the opponent for each number of lines cleared, a
+# t-spin sends twice the lines it clears
+garbage_lines = (0, 0, 1, 2, 4)
+
+
+def garbage_sent(result):
+    if result.t_spin == "t_spin":
+        return 2 * result.lines_cleared
+    return garbage_lines[result.lines_cleared]
+
+
+def message(kind, payload=b""):
+    return header.pack(kind, len(payload)) + payload
+
+
+def encode_board(game):
+    # The visible lines, unchanged lines are the same bytes objects
+    return game.grid[: game.visible_height]
+
+
+def encode_state(game):
+    return frame_header.pack(
+        game.score & 0xFFFFFFFF,
+        min(game.level, 0xFFFF),
+        min(game.lines, 0xFFFF),
+        shape_codes[game.next_shape],
+        shape_codes[game.current_shape],
+        game.current_column or 0,
+        game.current_row or 0,
+        game.current_rotation or 0,
+        min(game.pending_garbage, 0xFF),
+    )
+
+
+def encode_frame(game):
+    return encode_state(game) + b"".join(encode_board(game))
+
+
+def load_state(game, payload):
+    # Loads the state of a frame or a delta in a game only used to draw it
+    (
+        game.score,
+        game.level,
+        game.lines,
+        next_code,
+        current_code,
+        game.current_column,
+        game.current_row,
+        game.current_rotation,
+        pending_garbage,
+    ) = frame_header.unpack_from(payload)
+    game.next_shape = shapes[next_code - 1]
+    game.current_shape = shapes[current_code - 1]
+    game.debug_lines = (
+        ("incoming garbage: {}".format(pending_garbage),) if pending_garbage else ()
+    )
+
+
+def load_board(game, board):
+    # Unchanged lines are kept so that their rendering stays cached
+    width = game.width
+    visible = []
+    for r in range(game.visible_height):
+        line = bytes(board[r * width : (r + 1) * width])
+        visible.append(game.grid[r] if line == game.grid[r] else line)
+    game.grid = (*visible, *game.grid[game.visible_height :])
+    game.rows = tuple(row_mask(line, width) for line in game.grid)
+    game.surface = game.compute_surface()
+
+
+def load_frame(game, payload):
+    load_state(game, payload)
+    board = bytearray(payload[frame_header.size :])
+    load_board(game, board)
+    return board
+
+
+def load_delta(game, board, payload):
+    load_state(game, payload)
+    for index, code in changed_cell.iter_unpack(payload[frame_header.size :]):
+        board[index] = code
+    load_board(game, board)
+
+
+async def read_message(reader):
+    kind, length = header.unpack(await reader.readexactly(header.size))
+    return kind, await reader.readexactly(length)
+
+
+class Broadcast:
+    # Encodes the frames of a game once for all its spectators: each publish
+    # builds one delta against the previous one. Spectators which read too
+    # slowly stop receiving deltas and resume with the next keyframe.
+    keyframe_interval = 30
+    high_water = 16 * 1024
+
+    def __init__(self, game, hello):
+        self.game = game
+        self.hello = hello
+        # spectator writer: whether it got every delta since its last frame
+        self.subscribers = {}
+        self.state = encode_state(game)
+        self.board = encode_board(game)
+        self.keyframe_message = None
+        self.frames = 0
+        self.deltas_sent = 0
+        self.keyframes_sent = 0
+        self.frames_skipped = 0
+
+    def keyframe(self):
+        if self.keyframe_message is None:
+            self.keyframe_message = message(FRAME, self.state + b"".join(self.board))
+        return self.keyframe_message
+
+    def subscribe(self, writer):
+        writer.write(self.hello + self.keyframe())
+        self.keyframes_sent += 1
+        self.subscribers[writer] = True
+
+    def unsubscribe(self, writer):
+        self.subscribers.pop(writer, None)
+
+    def publish(self):
+        state = encode_state(self.game)
+        board = encode_board(self.game)
+        width = self.game.width
+        changes = []
+        for r, (old, new) in enumerate(zip(self.board, board)):
+            # unchanged lines are the same bytes
+            if old is not new and old != new:
+                changes.extend(
+                    changed_cell.pack(r * width + c, code)
+                    for c, (old_code, code) in enumerate(zip(old, new))
+                    if old_code != code
+                )
+        if not changes and state == self.state:
+            return
+        self.state = state
+        self.board = board
+        self.keyframe_message = None
+        self.frames += 1
+        delta = message(DELTA, state + b"".join(changes))
+        keyframe_due = self.frames % self.keyframe_interval == 0
+        for writer, synced in self.subscribers.items():
+            if writer.transport.get_write_buffer_size() > self.high_water:
+                self.subscribers[writer] = False
+                self.frames_skipped += 1
+            elif synced:
+                writer.write(delta)
+                self.deltas_sent += 1
+            elif keyframe_due:
+                writer.write(self.keyframe())
+                self.keyframes_sent += 1
+                self.subscribers[writer] = True
+
+    def close(self, final_message):
+        self.publish()
+        for writer, synced in self.subscribers.items():
+            if not synced:
+                writer.write(self.keyframe())
+            writer.write(final_message)
+            writer.close()
+        self.subscribers.clear()
+
+
+class Session:
+    # Frames are skipped while more than this many bytes wait to be sent
+    high_water = 16 * 1024
+
+    def __init__(self, server, reader, writer):
+        self.server = server
+        self.reader = reader
+        self.writer = writer
+        self.game = None
+        self.id = None
+        self.opponent = None
+        self.broadcast = None
+        self.watching = None
+        self.tasks = []
+        self.finished = False
+        self.frames_sent = 0
+        self.frames_skipped = 0
+
+    def send(self, kind, payload=b""):
+        self.writer.write(message(kind, payload))
+
+    def start(self, seed):
+        self.game = game = Game(seed=seed)
+        game.render_scheduler = RenderScheduler(game, self.server.fps, self.send_frame)
+        self.id = self.server.add_game(self)
+        self.send(HELLO, hello.pack(game.width, game.visible_height, seed, self.id))
+        game.new_tetromino()
+        self.tasks = [create_task(game.render_scheduler.run())]
+        self.server.gravity.add(game, self.fall)
+
+    def watch(self, writer):
+        if self.broadcast is None:
+            game = self.game
+            self.broadcast = Broadcast(
+                game,
+                message(
+                    HELLO,
+                    hello.pack(game.width, game.visible_height, game.bag.seed, self.id),
+                ),
+            )
+        self.broadcast.subscribe(writer)
+        return self.broadcast
+
+    def send_frame(self):
+        if self.broadcast is not None:
+            self.broadcast.publish()
+        if self.writer.is_closing():
+            return
+        if self.writer.transport.get_write_buffer_size() > self.high_water:
+            # The client reads too slowly, retry on the next frame
+            self.frames_skipped += 1
+            self.game.render_scheduler.request()
+            return
+        self.send(FRAME, encode_frame(self.game))
+        self.frames_sent += 1
+
+    def step(self, action):
+        self.handle_result(self.game.step(action))
+
+    def handle_result(self, result):
+        if self.opponent is not None:
+            lines = garbage_sent(result)
+            if lines:
+                self.opponent.game.receive_garbage(lines)
+                self.opponent.game.render()
+        if result.game_over:
+            self.finish()
+
+    def fall(self, rows):
+        self.handle_result(self.game.fall(rows))
+
+    async def run(self):
+        mode = await self.reader.readexactly(1)
+        if mode == WATCH:
+            (watched_id,) = game_id.unpack(await self.reader.readexactly(game_id.size))
+            watched = self.server.games.get(watched_id)
+            if watched is None:
+                self.send(GAME_OVER, game_over.pack(0, False))
+                return
+            self.watching = watched.watch(self.writer)
+        elif mode == VERSUS:
+            self.server.pair(self)
+        else:
+            self.start(randrange(1 << 32))
+        while not self.finished:
+            data = await self.reader.read(256)
+            if not data:
+                break
+            if self.game is None:
+                # waiting for an opponent or watching
+                continue
+            for code in data:
+                if code < len(recorded_actions):
+                    self.step(recorded_actions[code])
+                if self.finished:
+                    break
+
+    def finish(self, won=False):
+        if self.finished:
+            return
+        self.finished = True
+        game = self.game
+        if game is not None:
+            game.game_over = True
+            game.render_scheduler.stop()
+            game.render_scheduler.flush()
+            final_message = message(
+                GAME_OVER, game_over.pack(game.score & 0xFFFFFFFF, won)
+            )
+            self.writer.write(final_message)
+            if self.broadcast is not None:
+                self.broadcast.close(final_message)
+            self.server.games.pop(self.id, None)
+            self.server.gravity.remove(game)
+            self.server.games_played += 1
+        if self.watching is not None:
+            self.watching.unsubscribe(self.writer)
+        for task in self.tasks:
+            task.cancel()
+        self.writer.close()
+        opponent = self.opponent
+        if opponent is not None:
+            self.opponent = opponent.opponent = None
+            opponent.finish(not won)
+
+
+class Server:
+    def __init__(self, fps=30):
+        self.fps = fps
+        self.sessions = set()
+        # playing sessions by game id
+        self.games = {}
+        self.next_id = 0
+        self.waiting = None
+        self.games_played = 0
+        # one task drives the gravity of all the games
+        self.gravity = GravityWheel()
+        self.gravity_task = None
+
+    def add_game(self, session):
+        self.next_id += 1
+        self.games[self.next_id] = session
+        return self.next_id
+
+    def pair(self, session):
+        opponent = self.waiting
+        if opponent is None:
+            self.waiting = session
+            session.send(WAITING)
+            return
+        self.waiting = None
+        session.opponent = opponent
+        opponent.opponent = session
+        # Both players get the same tetrominoes
+        seed = randrange(1 << 32)
+        opponent.start(seed)
+        session.start(seed)
+
+    async def handle(self, reader, writer):
+        session = Session(self, reader, writer)
+        self.sessions.add(session)
+        try:
+            await session.run()
+        except (ConnectionError, IncompleteReadError):
+            pass
+        finally:
+            self.sessions.discard(session)
+            if self.waiting is session:
+                self.waiting = None
+            session.finish()
+
+    def spectators(self):
+        return sum(
+            len(session.broadcast.subscribers)
+            for session in self.games.values()
+            if session.broadcast is not None
+        )
+
+    async def start(self, host="127.0.0.1", port=0):
+        if self.gravity_task is None:
+            self.gravity_task = create_task(self.gravity.run())
+        return await start_server(self.handle, host, port, backlog=4096)
+
+
+async def serve(host, port, fps):
+    server = Server(fps)
+    listener = await server.start(host, port)
+    print("listening on", *listener.sockets[0].getsockname()[:2], file=stderr)
+    async with listener:
+        while True:
+            await sleep(5)
+            print(
+                "sessions: {}, spectators: {}, games played: {}, {}".format(
+                    len(server.sessions),
+                    server.spectators(),
+                    server.games_played,
+                    server.gravity.report(),
+                ),
+                file=stderr,
+            )
+
+
+async def send_keys(writer, view, das, arr):
+    def on_action(action, time):
+        if action == "redraw":
+            if view.current_shape is not None:
+                view.redraw()
+        elif action in action_codes:
+            writer.write(bytes((action_codes[action],)))
+
+    await Keyboard(on_action, das, arr).run(stdin)
+
+
+async def play_remote(
+    host, port, mode=SOLO, fps=60, watched_id=None, das=0.167, arr=0.033
+):
+    # Replaces handle_input and the game timer by a connection to a server,
+    # the local game only draws the frames received
+    reader, writer = await open_connection(host, port)
+    writer.write(mode)
+    if mode == WATCH:
+        writer.write(game_id.pack(watched_id))
+    view = None
+    board = None
+    tasks = []
+    try:
+        while True:
+            kind, payload = await read_message(reader)
+            if kind == WAITING:
+                print("waiting for an opponent")
+            elif kind == HELLO:
+                width, visible_height, seed, shown_id = hello.unpack(payload)
+                view = Game(grid=(bytes(width),) * visible_height * 2)
+                view.render_scheduler = RenderScheduler(view, fps)
+                tasks = [create_task(view.render_scheduler.run())]
+                if mode != WATCH:
+                    tasks.append(create_task(send_keys(writer, view, das, arr)))
+            elif kind in (FRAME, DELTA):
+                if kind == FRAME:
+                    board = load_frame(view, payload)
+                else:
+                    load_delta(view, board, payload)
+                view.debug_lines = ("game id: {}".format(shown_id), *view.debug_lines)
+                view.render()
+            elif kind == GAME_OVER:
+                score, won = game_over.unpack(payload)
+                if view is None:
+                    print("no such game")
+                    break
+                view.render_scheduler.stop()
+                view.render_scheduler.flush()
+                if mode == WATCH:
+                    print("game over, score:", score)
+                else:
+                    print("you win," if won else "game over,", "score:", score)
+                break
+    except IncompleteReadError:
+        print("connection lost")
+    finally:
+        for task in tasks:
+            task.cancel()
+        writer.close()
+        show_cursor()
+
+
+load_actions = ("left", "right", "cw", "ccw", "soft", "hard")
+
+
+class LoadStats:
+    def __init__(self):
+        self.sessions = 0
+        self.games_over = 0
+        self.frames = 0
+        self.spectators = 0
+        self.deltas = 0
+        self.bytes = 0
+        self.errors = 0
+
+    def report(self, elapsed):
+        return (
+            "{} sessions, {} spectators, {} games over, {} errors, "
+            "{:.0f} frames/s, {:.0f} deltas/s, {:.0f} kB/s".format(
+                self.sessions,
+                self.spectators,
+                self.games_over,
+                self.errors,
+                self.frames / elapsed,
+                self.deltas / elapsed,
+                self.bytes / elapsed / 1000,
+            )
+        )
+
+
+async def load_spectator(host, port, watched_id, stats):
+    # Watches a game until it ends and returns its last frame, rebuilt from
+    # the deltas received
+    reader, writer = await open_connection(host, port)
+    stats.spectators += 1
+    writer.write(WATCH + game_id.pack(watched_id))
+    state = board = None
+    try:
+        while True:
+            kind, payload = await read_message(reader)
+            stats.bytes += header.size + len(payload)
+            if kind == FRAME:
+                stats.frames += 1
+                state = payload[: frame_header.size]
+                board = bytearray(payload[frame_header.size :])
+            elif kind == DELTA:
+                stats.deltas += 1
+                state = payload[: frame_header.size]
+                for index, code in changed_cell.iter_unpack(
+                    payload[frame_header.size :]
+                ):
+                    board[index] = code
+            elif kind == GAME_OVER:
+                return None if state is None else state + board
+    finally:
+        writer.close()
+
+
+async def load_client(host, port, mode, rate, rng, stats, spectators=0):
+    # Plays random actions at about `rate` per second until the game ends
+    # and returns its last frame along with the ones seen by the spectators
+    reader, writer = await open_connection(host, port)
+    stats.sessions += 1
+    writer.write(mode)
+
+    async def send_actions():
+        while True:
+            await sleep(rng.expovariate(rate))
+            writer.write(bytes((action_codes[rng.choice(load_actions)],)))
+
+    sender = None
+    watchers = []
+    frame = None
+    try:
+        while True:
+            kind, payload = await read_message(reader)
+            stats.bytes += header.size + len(payload)
+            if kind == HELLO:
+                watched_id = hello.unpack(payload)[3]
+                watchers = [
+                    create_task(load_spectator(host, port, watched_id, stats))
+                    for i in range(spectators)
+                ]
+                sender = create_task(send_actions())
+            elif kind == FRAME:
+                stats.frames += 1
+                frame = payload
+            elif kind == GAME_OVER:
+                stats.games_over += 1
+                break
+        return frame, await gather(*watchers)
+    finally:
+        if sender is not None:
+            sender.cancel()
+        for watcher in watchers:
+            watcher.cancel()
+        writer.close()
+
+
+async def load_test(
+    host, port, sessions, rate=5, duration=10, mode=SOLO, seed=None, spectators=0
+):
+    stats = LoadStats()
+    rng = Random(seed)
+
+    async def client():
+        try:
+            await wait_for(
+                load_client(
+                    host, port, mode, rate, Random(rng.random()), stats, spectators
+                ),
+                duration,
+            )
+        except TimeoutError:
+            pass
+        except (ConnectionError, IncompleteReadError):
+            stats.errors += 1
+
+    start = perf_counter()
+    await gather(*(client() for i in range(sessions)))
+    return stats, perf_counter() - start
+
+
+def serve_command(args):
+    run(serve(args.host, args.port, args.fps))
+
+
+def connect_command(args):
+    if args.watch is not None:
+        mode = WATCH
+    elif args.versus:
+        mode = VERSUS
+    else:
+        mode = SOLO
+    run(
+        play_remote(
+            args.host,
+            args.port,
+            mode,
+            args.fps,
+            args.watch,
+            args.das / 1000,
+            args.arr / 1000,
+        )
+    )
+
+
+def loadgen_command(args):
+    stats, elapsed = run(
+        load_test(
+            args.host,
+            args.port,
+            args.sessions,
+            args.rate,
+            args.duration,
+            VERSUS if args.versus else SOLO,
+            args.seed,
+            args.spectators,
+        )
+    )
+    print(stats.report(elapsed))
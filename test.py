@@ -1,14 +1,87 @@
-from textwrap import dedent
+import asyncio
+import json
+import subprocess
+import sys
+import tracemalloc
 import unittest
+from io import StringIO
+from random import Random
+from tempfile import TemporaryDirectory
+from textwrap import dedent
+from time import monotonic
+
+from server import (
+    DELTA,
+    FRAME,
+    SOLO,
+    VERSUS,
+    Broadcast,
+    LoadStats,
+    Server,
+    load_client,
+    load_test,
+)
+from tetris import (
+    AutoPlayer,
+    Bag,
+    Game,
+    GravityWheel,
+    Keyboard,
+    Metrics,
+    Recorder,
+    Renderer,
+    RenderScheduler,
+    StepResult,
+    color_string,
+    garbage_code,
+    load_recording,
+    lock_delay,
+    piece_codes,
+    play_headless,
+    recorded_actions,
+    replay,
+    row_mask,
+    run_batch,
+    shapes,
+    spin_kinds,
+    tetromino_cells,
+)
 
-from tetris import Game
+try:
+    import numpy as np
 
+    from dataset import Dataset, DatasetWriter, sample_dtype
+    from vector import VectorGame
+except ImportError:
+    # numpy is only needed to export training data and for VectorGame
+    Dataset = VectorGame = None
 
 pink = [255, 192, 203]
 
 
+class BufferedWriter:
+    # Stands for a stream writer with `buffered` bytes not sent yet
+    def __init__(self):
+        self.transport = self
+        self.buffered = 0
+        self.messages = []
+
+    def get_write_buffer_size(self):
+        return self.buffered
+
+    def write(self, data):
+        self.messages.append(data[0])
+
+
 def game_with_grid(
-    matrix=None, shape=None, rotation=None, row=None, column=None, width=10, height=20
+    matrix=None,
+    shape=None,
+    rotation=None,
+    row=None,
+    column=None,
+    width=10,
+    height=20,
+    game_class=Game,
 ):
     if matrix is None:
         grid = None
@@ -19,10 +92,10 @@ def game_with_grid(
         # Double the rows count
         lines += ["0" * width for i in range(len(lines))]
         grid = [
-            [None if char in ("0", "░") else (" ", pink) for char in line]
+            [0 if char in ("0", "░") else garbage_code for char in line]
             for line in lines
         ]
-    game = Game(grid)
+    game = game_class(grid)
     game.test = True
     if shape is not None:
         game.current_shape = shape
@@ -35,6 +108,67 @@ def game_with_grid(
     return game
 
 
+def played_landings(game, shape):
+    # Where the tetromino can lock and the best spin kind of each landing,
+    # searched one move, rotation or row at a time with the game itself
+    spin_ranks = {None: 0, "mini_t_spin": 1, "t_spin": 2}
+    actions = {
+        "left": lambda: game.move(-1),
+        "right": lambda: game.move(1),
+        "cw": lambda: game.rotate(1),
+        "ccw": lambda: game.rotate(-1),
+        "down": lambda: setattr(game, "current_row", game.current_row - 1),
+    }
+    game.current_shape = shape
+    start = (*game.spawn_position(shape), 0)
+    queue = [start]
+    seen = {start}
+    landings = {}
+
+    def land(column, row, rotation, spin):
+        cells = frozenset(
+            (row + i, column + j) for i, j in tetromino_cells[shape][rotation]
+        )
+        landings[cells] = max(landings.get(cells, 0), spin)
+
+    if game.tetromino_touches_ground(shape, *start):
+        land(*start, 0)
+    for state in queue:
+        for action, play in actions.items():
+            column, row, rotation = state
+            if action == "down" and game.tetromino_touches_ground(shape, *state):
+                continue
+            game.current_column, game.current_row, game.current_rotation = state
+            game.last_movement = None
+            play()
+            next_state = (game.current_column, game.current_row, game.current_rotation)
+            if next_state == state:
+                continue
+            if next_state not in seen:
+                seen.add(next_state)
+                queue.append(next_state)
+            if game.tetromino_touches_ground(shape, *next_state):
+                spin = 0
+                column, row, rotation = next_state
+                if (
+                    game.last_movement == "rotate"
+                    and game.t_corner_count(row, column) >= 3
+                ):
+                    spin = 1 if game.wall_kicked else 2
+                land(*next_state, spin)
+    return landings
+
+
+def dropped_row(game):
+    # The landing row found by moving the tetromino down one row at a time
+    row = game.current_row
+    while not game.tetromino_touches_ground(
+        game.current_shape, game.current_column, row, game.current_rotation
+    ):
+        row -= 1
+    return row
+
+
 class TestTetris(unittest.TestCase):
     def test_initial_score_and_level(self):
         game = Game()
@@ -111,6 +245,649 @@ class TestTetris(unittest.TestCase):
         self.assertEqual(game.wall_kicked, True)
         self.assertEqual(game.score, 200)
 
+    def test_line_clear_keeps_rows_and_grid_in_sync(self):
+        matrix = """
+            ░░░░░░░░░░
+            ░█████████
+            ░█████████
+        """
+        game = game_with_grid(matrix, "i", 1, 0, -2)
+        game.move_down()
+        self.assertEqual(game.score, 300)
+        self.assertEqual(
+            game.rows,
+            tuple(row_mask(line, game.width) for line in game.grid),
+        )
+        self.assertEqual(game.grid[0][0], piece_codes["i"])
+        self.assertEqual(game.grid[0][4], 0)
+        self.assertTrue(game.tetromino_fits("i", 6, 0, 0))
+        self.assertFalse(game.tetromino_fits("i", 7, 0, 0))
+        self.assertFalse(game.tetromino_fits("i", -3, 0, 1))
+
+    def test_renderer_only_sends_changed_cells(self):
+        stream = StringIO()
+        renderer = Renderer(stream)
+        renderer.draw(["┃" + color_string("  ", pink) + "    ┃", "abc"])
+        first = stream.getvalue()
+        self.assertIn("\x1b[2J", first)
+        # the cursor is left below the frame
+        self.assertTrue(first.endswith("\x1b[3;1H"))
+        renderer.draw(["┃" + color_string("  ", pink) + "    ┃", "abc"])
+        self.assertEqual(stream.getvalue(), first)
+        renderer.draw(["┃  " + color_string("  ", pink) + "  ┃", "ab"])
+        self.assertEqual(
+            stream.getvalue()[len(first) :],
+            "\x1b[1;2H  " + color_string("  ", pink) + "\x1b[2;3H\x1b[K\x1b[3;1H",
+        )
+
+    def test_render_scheduler_coalesces_frames(self):
+        drawn = []
+
+        class DrawnGame(Game):
+            __slots__ = ()
+
+            def draw(self):
+                drawn.append(self.current_column)
+
+        game = game_with_grid(None, "t", 0, 10, 4, game_class=DrawnGame)
+        scheduler = game.render_scheduler = RenderScheduler(game, fps=50)
+
+        async def play():
+            task = asyncio.create_task(scheduler.run())
+            for i in range(3):
+                game.move(1)
+            await asyncio.sleep(0.01)
+            game.move(-1)
+            game.move(-1)
+            await asyncio.sleep(0.05)
+            scheduler.stop()
+            await task
+
+        asyncio.run(play())
+        self.assertEqual(drawn, [7, 5])
+        self.assertEqual(scheduler.frames_rendered, 2)
+        self.assertEqual(scheduler.frames_coalesced, 3)
+
+    def test_headless_step(self):
+        matrix = """
+            ░░░░░░██░░
+            ████░░░███
+            █████░████
+        """
+        game = game_with_grid(matrix, "t", 3, 0, 4)
+        game.headless = True
+        self.assertEqual(game.step("ccw"), StepResult(0, None, 0, False))
+        self.assertEqual(game.step("hard"), StepResult(2, "t_spin", 1200, False))
+        self.assertEqual(game.step("soft"), StepResult(0, None, 1, False))
+        self.assertEqual(game.step("gravity").score_delta, 0)
+
+    def test_ghost_row_matches_a_row_by_row_drop(self):
+        matrix = """
+            ████░░░░░░
+            ░░░░░░░░██
+            ░░░░░░░░░█
+        """
+        # under the overhang, above the top of its columns
+        game = game_with_grid(matrix, "t", 0, 0, 1)
+        game.headless = True
+        self.assertEqual(game.get_ghost_row(), dropped_row(game))
+        # its flat side on the floor
+        self.assertEqual(game.get_ghost_row(), -1)
+        for action in ["right", "right", "right", "cw", "right", "ccw"]:
+            game.step(action)
+            self.assertEqual(game.get_ghost_row(), dropped_row(game))
+        # the same position on a new board
+        game.add_garbage(2)
+        self.assertEqual(game.get_ghost_row(), dropped_row(game))
+        random = Random(2)
+        for _ in range(300):
+            game.step(random.choice(["left", "right", "cw", "ccw", "soft", "hard"]))
+            if game.game_over:
+                break
+            self.assertEqual(game.get_ghost_row(), dropped_row(game))
+
+    def test_soft_and_gravity_locks_render(self):
+        # the frame after a lock shows the locked tetromino and the next one
+        rendered = []
+
+        class RenderedGame(Game):
+            __slots__ = ()
+
+            def render(self):
+                rendered.append(self.pieces)
+
+        for action in ("soft", "gravity"):
+            game = RenderedGame(seed=1)
+            game.new_tetromino()
+            game.current_row = game.get_ghost_row()
+            rendered.clear()
+            game.step(action)
+            self.assertEqual(game.pieces, 1)
+            self.assertIn(1, rendered)
+
+    def test_batch_matches_sequential_games(self):
+        summaries = sorted(run_batch("random", 6, first_seed=10, workers=2))
+        self.assertEqual(
+            summaries, [play_headless(seed, "random") for seed in range(10, 16)]
+        )
+        self.assertTrue(all(summary.pieces > 0 for summary in summaries))
+
+    @unittest.skipIf(Dataset is None, "numpy is not installed")
+    def test_export_placements(self):
+        seeds = range(3)
+        for bitplanes in (False, True):
+            with TemporaryDirectory() as directory:
+                writer = DatasetWriter(directory, chunk_size=16, bitplanes=bitplanes)
+                summaries = [
+                    play_headless(seed, "random", 20, writer) for seed in seeds
+                ]
+                writer.close()
+                dataset = Dataset(directory)
+                self.assertEqual(len(dataset), sum(s.pieces for s in summaries))
+                self.assertEqual(list(dataset.games["seed"]), list(seeds))
+                for index, summary in enumerate(summaries):
+                    boards, samples = dataset.game(index)
+                    self.assertEqual(len(samples), summary.pieces)
+                    self.assertEqual(samples["reward"].sum(), summary.score)
+                    shapes = Bag(summary.seed).peek(len(samples))
+                    self.assertEqual(
+                        list(samples["shape"]), [piece_codes[s] for s in shapes]
+                    )
+                    # games start on an empty board that fills up
+                    cells = dataset.unpack(boards) != 0
+                    self.assertFalse(cells[0].any())
+                    self.assertEqual(cells[1].sum(), 4)
+                boards, samples = next(dataset.chunks())
+                self.assertIsInstance(boards, np.memmap)
+                self.assertFalse(boards.flags.writeable)
+            # a game without samples, in a dataset without any
+            with TemporaryDirectory() as directory:
+                writer = DatasetWriter(directory, bitplanes=bitplanes)
+                play_headless(0, "random", 0, writer)
+                writer.close()
+                boards, samples = Dataset(directory).game(0)
+                width = 2 if bitplanes else 10
+                self.assertEqual(boards.shape, (0, writer.height, width))
+                self.assertEqual(samples.dtype, sample_dtype)
+                self.assertEqual(len(samples), 0)
+
+    @unittest.skipIf(VectorGame is None, "numpy is not installed")
+    def test_vector_game_matches_game(self):
+        matrix = """
+            ░░░░░░░░░░
+            ██░░███░░█
+            ████░█████
+        """
+        seeds = range(6)
+        player = AutoPlayer(budget=None)
+        random = Random(0)
+        for grid in (None, game_with_grid(matrix).grid):
+            games = [Game(grid, headless=True, seed=seed) for seed in seeds]
+            vector = VectorGame(seeds, grid)
+            paths = [[] for game in games]
+            for _ in range(500):
+                # the autoplayer's moves with random ones in between, the last
+                # games only play random moves until they are over
+                for game, path in zip(games[:3], paths):
+                    if not path and not game.game_over:
+                        if game.current_shape is None:
+                            game.new_tetromino()
+                        path.extend(player.choose(game).path)
+                        if random.random() < 0.3:
+                            path.insert(0, random.choice(recorded_actions[:7]))
+                actions = [
+                    path.pop(0) if path else random.choice(recorded_actions[:7])
+                    for path in paths
+                ]
+                result = vector.step([recorded_actions.index(a) for a in actions])
+                for index, (game, action) in enumerate(zip(games, actions)):
+                    self.assertEqual(
+                        game.step(action),
+                        (
+                            result.lines_cleared[index],
+                            spin_kinds[result.t_spin[index]],
+                            result.score_delta[index],
+                            result.game_over[index],
+                        ),
+                    )
+                    self.assertEqual(game.grid, tuple(map(bytes, vector.grid[index])))
+                    for field in ("score", "level", "lines", "current_column"):
+                        self.assertEqual(
+                            getattr(game, field), getattr(vector, field)[index]
+                        )
+                    self.assertEqual(
+                        shapes.index(game.next_shape), vector.next_shape[index]
+                    )
+            self.assertTrue(any(game.t_spins for game in games))
+            self.assertTrue(all(game.game_over for game in games[3:]))
+        # the grids are views of the arrays stepped in place
+        self.assertIs(vector.grid.base, vector.board)
+
+    def test_placements_find_t_spin_double(self):
+        matrix = """
+            ░░░░░░██░░
+            ████░░░███
+            █████░████
+        """
+        game = game_with_grid(matrix)
+        game.headless = True
+        placements = game.placements("t")
+        self.assertEqual(len(placements), len(set(placements)))
+        [t_spin] = [p for p in placements if p[:3] == (4, 0, 2)]
+        self.assertEqual(t_spin.t_spin, "t_spin")
+        game.current_shape = "t"
+        game.current_column, game.current_row = game.spawn_position("t")
+        game.current_rotation = 0
+        for action in t_spin.path[:-1]:
+            game.step(action)
+        self.assertEqual(game.step(t_spin.path[-1]).lines_cleared, 2)
+        self.assertEqual(game.last_t_spin, "t_spin")
+
+    def test_placements_match_a_step_by_step_search(self):
+        random = Random(1)
+        for trial in range(20):
+            # stacks with overhangs and holes, never a complete line
+            heights = [random.randrange(8) for column in range(10)]
+            grid = [
+                [
+                    garbage_code if r < height and random.random() < 0.8 else 0
+                    for height in heights
+                ]
+                for r in range(40)
+            ]
+            for line in grid:
+                line[random.randrange(10)] = 0
+            game = Game(grid, headless=True)
+            for shape in shapes:
+                placements = {
+                    frozenset(
+                        (p.row + i, p.column + j)
+                        for i, j in tetromino_cells[shape][p.rotation]
+                    ): spin_kinds.index(p.t_spin)
+                    for p in game.placements(shape)
+                }
+                self.assertEqual(placements, played_landings(game, shape))
+
+    def test_autoplayer_tucks_under_an_overhang(self):
+        matrix = """
+            ░░░██░░░░░
+            ░░░██░░██░
+            ░░░█░█░█░░
+            ░░░░█░░██░
+            ░░░░░█░░█░
+            ░░░████░░░
+            ██░░███░█░
+        """
+        game = game_with_grid(matrix)
+        game.headless = True
+        game.next_shape = "o"
+        game.new_tetromino()
+        placement = AutoPlayer(budget=None, beam_width=1).choose(game)
+        self.assertEqual(placement[:3], (1, 1, 0))
+        # moved under the stack on the way down
+        self.assertIn("left", placement.path[placement.path.index("soft") :])
+        for action in placement.path[:-1]:
+            game.step(action)
+        self.assertEqual((game.current_column, game.current_row), (1, 1))
+        self.assertEqual(game.get_ghost_row(), 1)
+
+    def test_autoplayer_takes_the_tetris(self):
+        matrix = """
+            █████████░
+            █████████░
+            █████████░
+            █████████░
+        """
+        game = game_with_grid(matrix)
+        game.headless = True
+        game.next_shape = "i"
+        game.new_tetromino()
+        game.next_shape = "o"
+        placement = AutoPlayer(budget=None).choose(game)
+        for action in placement.path:
+            result = game.step(action)
+        self.assertEqual(result.lines_cleared, 4)
+
+    def test_seeded_bag(self):
+        bag = Bag(42)
+        self.assertEqual(bag.peek(3), bag.peek(3))
+        pieces = [next(bag) for i in range(70)]
+        other = Bag(42)
+        self.assertEqual([next(other) for i in range(70)], pieces)
+        for i in range(0, 70, 7):
+            self.assertEqual(sorted(pieces[i : i + 7]), sorted("ijlostz"))
+        state = bag.getstate()
+        following = bag.peek(10)
+        restored = Bag(0)
+        restored.setstate(state)
+        self.assertEqual([next(restored) for i in range(10)], following)
+        self.assertEqual(Game(seed=7).preview(5), Game(seed=7).preview(5))
+
+    def test_recording_replays_to_the_same_game(self):
+        game = Game(headless=True, seed=3)
+        game.new_tetromino()
+        game.recorder = Recorder(game)
+        autoplayer = AutoPlayer(budget=None, beam_width=2)
+        for i in range(30):
+            game.step("gravity")
+            game.step("left")
+            for action in autoplayer.choose(game).path:
+                game.step(action)
+        data = game.recorder.finish(game)
+        self.assertLess(len(data), 40 * 30)
+        recording = load_recording(data)
+        self.assertEqual(recording.score, game.score)
+        replayed = replay(recording)
+        self.assertEqual(replayed.score, game.score)
+        self.assertEqual(replayed.grid_hash(), recording.grid_hash)
+        self.assertEqual(replayed.pieces, 30)
+
+    def test_snapshot_and_restore(self):
+        game = Game(headless=True, seed=1)
+        autoplayer = AutoPlayer(budget=None, beam_width=2)
+        for i in range(12):
+            game.step("gravity")
+            for action in autoplayer.choose(game).path:
+                game.step(action)
+        state = game.snapshot()
+        actions = [*autoplayer.choose(game).path, "hard", "hard", "cw", "hard"]
+        results = [game.step(action) for action in actions]
+        after = game.snapshot()
+        self.assertNotEqual(after, state)
+        game.restore(state)
+        self.assertEqual(game.snapshot(), state)
+        self.assertEqual([game.step(action) for action in actions], results)
+        self.assertEqual(game.snapshot(), after)
+        # garbage holes are the same after a restore
+        game.add_garbage(1)
+        with_garbage = game.snapshot()
+        game.restore(after)
+        game.add_garbage(1)
+        self.assertEqual(game.snapshot(), with_garbage)
+        # while successive garbage lines get different holes
+        garbage_rows = set()
+        for _ in range(5):
+            game.add_garbage(1)
+            garbage_rows.add(game.rows[0])
+        self.assertGreater(len(garbage_rows), 1)
+
+    def test_surface_is_kept_up_to_date(self):
+        matrix = """
+            ░░░░░░░░░░
+            ░█░░░░░░░█
+            ░█░░░░░█░░
+            ░█████████
+        """
+        game = game_with_grid(matrix, "i", 1, 10, -2)
+        self.assertEqual(game.surface.heights, (0, 3, 1, 1, 1, 1, 1, 2, 1, 3))
+        self.assertEqual(game.surface.holes, (0, 0, 0, 0, 0, 0, 0, 0, 0, 1))
+        self.assertEqual(game.surface.wells, (3, 0, 0, 0, 0, 0, 0, 0, 1, 0))
+        self.assertEqual(game.surface.row_fills[:4], (9, 2, 2, 0))
+        game.hard_drop()
+        self.assertEqual(game.lines, 1)
+        self.assertEqual(game.surface, game.compute_surface())
+        self.assertEqual(game.surface.heights, (3, 2, 0, 0, 0, 0, 0, 1, 0, 2))
+        self.assertEqual(game.surface.holes, (0, 0, 0, 0, 0, 0, 0, 0, 0, 1))
+
+    def test_surface_matches_compute_surface_in_random_games(self):
+        # mostly hard drops, so the stack gets high and tetrominos spawn into it
+        actions = ["left", "right", "cw", "ccw", "soft"] + ["hard"] * 5
+        for seed in range(20):
+            game = Game(headless=True, seed=seed)
+            random = Random(seed)
+            while not game.game_over:
+                if random.random() < 0.05:
+                    game.receive_garbage(random.randrange(1, 4))
+                game.step(random.choice(actions))
+                self.assertEqual(game.surface, game.compute_surface())
+
+    def test_garbage_lines(self):
+        game = Game(headless=True, seed=1)
+        game.receive_garbage(2)
+        game.step("hard")
+        self.assertEqual(game.pending_garbage, 0)
+        self.assertEqual(game.rows[0], game.rows[1])
+        self.assertEqual(bin(game.rows[0] ^ game.full_row).count("1"), 1)
+        self.assertEqual(game.surface, game.compute_surface())
+        matrix = """
+            ░█████████
+        """
+        game = game_with_grid(matrix, "i", 1, 10, -2)
+        game.receive_garbage(3)
+        game.hard_drop()
+        self.assertEqual(game.lines, 1)
+        self.assertEqual(game.pending_garbage, 2)
+
+    def test_versus_server(self):
+        async def play():
+            server = Server(fps=60)
+            listener = await server.start()
+            port = listener.sockets[0].getsockname()[1]
+            async with listener:
+                stats, elapsed = await load_test(
+                    "127.0.0.1", port, 4, rate=500, duration=20, mode=VERSUS, seed=0
+                )
+            self.assertEqual(stats.errors, 0)
+            self.assertEqual(stats.games_over, 4)
+            self.assertEqual(server.games_played, 4)
+            self.assertGreater(stats.frames, 0)
+            self.assertFalse(server.sessions)
+
+        asyncio.run(play())
+
+    def test_spectators_rebuild_the_frames(self):
+        async def play():
+            server = Server(fps=60)
+            listener = await server.start()
+            port = listener.sockets[0].getsockname()[1]
+            stats = LoadStats()
+            async with listener:
+                frame, watched = await load_client(
+                    "127.0.0.1", port, SOLO, 100, Random(0), stats, spectators=3
+                )
+            self.assertEqual(watched, [frame] * 3)
+            self.assertGreater(stats.deltas, 3)
+
+        asyncio.run(play())
+
+    def test_slow_spectators_skip_to_a_keyframe(self):
+        game = Game(headless=True, seed=1)
+        game.new_tetromino()
+        broadcast = Broadcast(game, b"")
+        broadcast.keyframe_interval = 4
+        fast = BufferedWriter()
+        slow = BufferedWriter()
+        broadcast.subscribe(fast)
+        broadcast.subscribe(slow)
+        slow.buffered = 1 << 20
+        for action in ["left", "right", "hard"]:
+            game.step(action)
+            broadcast.publish()
+        slow.buffered = 0
+        for action in ["left", "right", "cw", "ccw"]:
+            game.step(action)
+            broadcast.publish()
+        self.assertEqual(fast.messages, [FRAME, *[DELTA] * 7])
+        self.assertEqual(slow.messages, [FRAME, FRAME, DELTA, DELTA, DELTA])
+
+    def test_keyboard_decodes_batched_reads(self):
+        actions = []
+        keyboard = Keyboard(lambda action, time: actions.append(action))
+        self.assertTrue(keyboard.feed(b"\x1b[A\x1b[1;2Dx\x1bOB \x1b", 0))
+        self.assertTrue(keyboard.feed(b"[C\x1b\x1b[Bq", 1))
+        self.assertEqual(
+            actions, ["cw", "left", "ccw", "soft", "hard", "right", "soft", "quit"]
+        )
+        self.assertFalse(keyboard.feed(b"p\x04x", 2))
+        self.assertEqual(actions[-1], "pause")
+
+    def test_keyboard_auto_repeat(self):
+        async def hold():
+            times = []
+            keyboard = Keyboard(
+                lambda action, time: times.append(time),
+                das=0.05,
+                arr=0.005,
+                release_timeout=0.04,
+            )
+            # the terminal repeats the key every 20 ms after 60 ms
+            start = monotonic()
+            keyboard.feed(b"\x1b[C", start)
+            await asyncio.sleep(0.06)
+            for i in range(5):
+                keyboard.feed(b"\x1b[C", monotonic())
+                await asyncio.sleep(0.02)
+            await asyncio.sleep(0.1)
+            return start, times, keyboard
+
+        start, times, keyboard = asyncio.run(hold())
+        self.assertIsNone(keyboard.repeater)
+        # a move for the first press and its first repeat, then ours
+        self.assertEqual(times[0], start)
+        self.assertGreater(len(times), 2 + 5)
+        self.assertLess(times[-1] - start, 0.06 + 5 * 0.02 + 0.04)
+
+    def test_high_gravity_falls_once_per_frame(self):
+        rows_rendered = []
+
+        class RenderedGame(Game):
+            __slots__ = ()
+
+            def render(self):
+                rows_rendered.append(self.current_row)
+
+        async def play():
+            game = RenderedGame(seed=1)
+            game.level = 20
+            game.new_tetromino()
+            landing_row = game.get_ghost_row()
+            ticks = 0
+            start = monotonic()
+            async for rows in game.timer():
+                ticks += 1
+                game.fall(rows)
+                if game.pieces:
+                    break
+            return game, landing_row, rows_rendered, ticks, monotonic() - start
+
+        game, landing_row, rows_rendered, ticks, elapsed = asyncio.run(play())
+        self.assertEqual(game.gravity(), 20)
+        # straight to the ground in one render, then locked after the delay
+        self.assertEqual(rows_rendered[0], landing_row)
+        self.assertGreaterEqual(elapsed, lock_delay)
+        self.assertLessEqual(ticks, elapsed * 60 + 2)
+
+    def test_gravity_wheel_drives_many_games(self):
+        class FastGame(Game):
+            __slots__ = ()
+
+            def interval(self):
+                return 0.02
+
+        async def play():
+            wheel = GravityWheel()
+            task = asyncio.create_task(wheel.run())
+            games = [Game(headless=True, seed=seed) for seed in range(200)]
+            games[0] = FastGame(headless=True, seed=0)
+            for game in games:
+                game.new_tetromino()
+                wheel.add(game)
+            fast, paused, removed = games[:3]
+            wheel.reschedule(fast)
+            paused.pause()
+            wheel.remove(removed)
+            # level 1 games fall one row after a second
+            await asyncio.sleep(1.3)
+            task.cancel()
+            return wheel, games
+
+        wheel, games = asyncio.run(play())
+        fast, paused, removed, *others = games
+        spawn_row = paused.visible_height
+        self.assertEqual(fast.pieces, 1)
+        self.assertEqual(paused.current_row, spawn_row)
+        self.assertEqual(removed.current_row, spawn_row)
+        self.assertEqual({game.current_row for game in others}, {spawn_row - 1})
+        # the games due in the same frame fall together, the fast one alone
+        self.assertLess(wheel.batches, wheel.ticks - len(others) * 3 // 4)
+        self.assertGreater(len(wheel.lags), 60)
+        self.assertIn("gravity lag p50", wheel.report())
+
+    def test_gravity_wheel_reschedules_without_duplicates(self):
+        wheel = GravityWheel()
+        game = Game(headless=True, seed=1)
+        game.new_tetromino()
+        falls = []
+        timer = wheel.add(game, falls.append)
+        due = timer.due
+        wheel.reschedule(game)
+        wheel.reschedule(game)
+        self.assertEqual(timer.due, due)
+        self.assertEqual(len(wheel.slots[due % len(wheel.slots)]), 1)
+        wheel.advance(due, timer.deadline)
+        self.assertEqual(wheel.ticks, 1)
+        self.assertEqual(len(falls), 1)
+
+    def test_metrics_time_the_game_while_attached(self):
+        game = Game(headless=True, seed=1)
+        output = StringIO()
+        metrics = Metrics(output)
+        metrics.attach(game)
+        for i in range(5):
+            game.step("hard")
+        metrics.export()
+        summary = json.loads(output.getvalue())
+        self.assertEqual(summary["lock"]["count"], 5)
+        self.assertLessEqual(summary["lock"]["p50_ms"], summary["lock"]["p100_ms"])
+        self.assertIn("move_down", summary)
+        metrics.detach(game)
+        self.assertIsNone(game.metrics)
+        self.assertIs(type(game), Game)
+        game.step("hard")
+        self.assertEqual(len(metrics.samples["lock"]), 5)
+
+    def test_render_grid_cache_follows_the_grid(self):
+        game = Game(headless=True, seed=3)
+        game.new_tetromino()
+        for action in ["hard", "left", "hard", "cw", "hard", "right", "right"]:
+            game.render_grid()
+            game.step(action)
+        uncached = Game(game.grid, seed=3)
+        uncached.restore(game.snapshot())
+        self.assertIsNone(uncached.line_strings)
+        self.assertEqual(game.render_grid(), uncached.render_grid())
+
+    def test_idle_game_memory(self):
+        Game()
+        tracemalloc.start()
+        try:
+            games = [Game(seed=i) for i in range(1000)]
+            for game in games:
+                game.new_tetromino()
+            size = tracemalloc.get_traced_memory()[0] / len(games)
+        finally:
+            tracemalloc.stop()
+        self.assertLess(size, 1024)
+        self.assertIsNot(games[0].bag, games[1].bag)
+        self.assertFalse(hasattr(Game(), "__dict__"))
+
+    def test_import_without_a_terminal(self):
+        # The interactive parts are only imported when they are used
+        code = (
+            "import sys, tetris; "
+            "tetris.Game(seed=0).new_tetromino(); "
+            "print(' '.join(sorted(sys.modules)), file=sys.stderr)"
+        )
+        process = subprocess.run(
+            [sys.executable, "-c", code],
+            stdin=subprocess.DEVNULL,
+            capture_output=True,
+            check=True,
+        )
+        modules = process.stderr.decode().split()
+        for module in ("argparse", "asyncio", "multiprocessing", "termios"):
+            self.assertNotIn(module, modules)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -2,21 +2,16 @@
 
 # [0, 0] is the bottom left
 
-from asyncio import (
-    StreamReader,
-    StreamReaderProtocol,
-    create_task,
-    get_event_loop,
-    run,
-    sleep,
-)
+# Only what the engine needs is imported here: asyncio, termios and the
+# command line tools are imported by the interactive parts that use them, so
+# that importing the module stays fast and works without a terminal.
+from collections import deque, namedtuple
 from contextlib import contextmanager
-from copy import deepcopy
-from random import choice
-from sys import stdin, stdout
-from termios import ECHO, ICANON, TCSADRAIN, tcgetattr, tcsetattr
-from textwrap import dedent
-from time import time
+from os import cpu_count, get_terminal_size
+from random import Random, randrange
+from sys import stderr, stdin, stdout
+from time import monotonic, perf_counter
+from time import sleep as sleep_blocking
 
 tetrominoes = {
     "i": [
@@ -322,15 +317,17 @@ wall_kicks = {
     "i": i_wall_kicks,
 }
 
-shapes = list(tetrominoes.keys())
+shapes = tuple(tetrominoes)
+
+blue = (0, 0, 255)
+orange = (252, 171, 0)
+yellow = (255, 255, 0)
+green = (0, 255, 0)
+purple = (154, 0, 254)
+red = (255, 0, 0)
+cyan = (0, 255, 255)
 
-blue = [0, 0, 255]
-orange = [252, 171, 0]
-yellow = [255, 255, 0]
-green = [0, 255, 0]
-purple = [154, 0, 254]
-red = [255, 0, 0]
-cyan = [0, 255, 255]
+gray = (128, 128, 128)
 
 tetromino_colors = {
     "j": blue,
@@ -342,6 +339,12 @@ tetromino_colors = {
     "i": cyan,
 }
 
+# Cells of the grid are stored as these codes, their colors are only looked
+# up when rendering
+piece_codes = {shape: code for code, shape in enumerate(shapes, 1)}
+garbage_code = len(shapes) + 1
+code_colors = (None, *(tetromino_colors[shape] for shape in shapes), gray)
+
 mini_t_spin_points = {
     0: 100,
     1: 200,
@@ -364,32 +367,377 @@ points = {
 render_width_multiplier = 2
 
 
+# Seeded 7-bag tetromino generator: each bag is one of the 5040 orders of
+# the 7 tetrominoes, drawn from a splitmix64 sequence whose whole state is a
+# single integer. Generated tetrominoes are kept as shape indexes so any
+# position can be peeked at or returned to, and the whole state is the
+# (seed, position) pair.
+mask64 = (1 << 64) - 1
+bag_orders = 5040
+
+
+def splitmix64(state):
+    # Returns the next state and its random 64 bits number
+    state = (state + 0x9E3779B97F4A7C15) & mask64
+    z = state
+    z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & mask64
+    z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & mask64
+    return state, z ^ (z >> 31)
+
+
+def bag_order(order):
+    # The shape indexes of a bag, the order's digits in the factorial number
+    # system pick each remaining tetromino
+    remaining = list(range(len(shapes)))
+    pieces = []
+    for n in range(len(shapes), 0, -1):
+        order, index = divmod(order, n)
+        pieces.append(remaining.pop(index))
+    return pieces
+
+
+class Bag:
+    __slots__ = ("seed", "state", "pieces", "position")
+
+    def __init__(self, seed=None):
+        if seed is None:
+            seed = randrange(1 << 64)
+        self.seed = seed
+        self.state = seed & mask64
+        self.pieces = bytearray()
+        self.position = 0
+
+    def fill(self, count):
+        pieces = self.pieces
+        while len(pieces) < count:
+            self.state, number = splitmix64(self.state)
+            pieces.extend(bag_order(number % bag_orders))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.position >= len(self.pieces):
+            self.fill(self.position + 1)
+        shape = shapes[self.pieces[self.position]]
+        self.position += 1
+        return shape
+
+    def peek(self, count):
+        end = self.position + count
+        self.fill(end)
+        return [shapes[piece] for piece in self.pieces[self.position : end]]
+
+    def getstate(self):
+        return self.seed, self.position
+
+    def setstate(self, state):
+        seed, position = state
+        if seed != self.seed:
+            self.__init__(seed)
+        self.position = position
+
+
+# Playfield rows are stored as integer bitmasks: bit `row_padding + x` is set
+# when column x is filled. The padding bits on both sides are always set and
+# act as walls, so a single AND against a shifted tetromino line mask tells
+# whether it collides with the walls or with locked cells.
+row_padding = 4
+
+
+def tetromino_line_masks(shape, rotation):
+    # (row offset from the bottom of the tetromino, bitmask) for each non
+    # empty line of the tetromino
+    return tuple(
+        (i, sum(1 << j for j, cell in enumerate(line) if cell))
+        for i, line in enumerate(reversed(tetrominoes[shape][rotation]))
+        if any(line)
+    )
+
+
+tetromino_masks = {
+    shape: tuple(tetromino_line_masks(shape, rotation) for rotation in range(4))
+    for shape in shapes
+}
+
+
+# Tables derived from tetrominoes and wall_kicks once at import time so that
+# the hot paths never have to walk the nested lists again.
+
+# (row offset, column offset) of each filled cell, from the bottom left
+tetromino_cells = {
+    shape: tuple(
+        tuple(
+            (i, j)
+            for i, line in enumerate(reversed(tetrominoes[shape][rotation]))
+            for j, cell in enumerate(line)
+            if cell
+        )
+        for rotation in range(4)
+    )
+    for shape in shapes
+}
+
+# (min row offset, min column offset, max row offset, max column offset)
+tetromino_bounds = {
+    shape: tuple(
+        (
+            min(i for i, j in cells),
+            min(j for i, j in cells),
+            max(i for i, j in cells),
+            max(j for i, j in cells),
+        )
+        for cells in tetromino_cells[shape]
+    )
+    for shape in shapes
+}
+
+# (dx, dy) offsets to try, keyed by (shape, from rotation, to rotation)
+kick_table = {
+    (shape, from_rotation, to_rotation): tuple(tuple(kick) for kick in kicks)
+    for shape, table in wall_kicks.items()
+    for from_rotation, targets in table.items()
+    for to_rotation, kicks in targets.items()
+}
+
+
+def tetromino_orientation(shape, rotation):
+    # The first rotation covering the same cells, up to a translation
+    min_i, min_j = tetromino_bounds[shape][rotation][:2]
+    for other in range(rotation + 1):
+        other_min_i, other_min_j = tetromino_bounds[shape][other][:2]
+        if {(i - min_i, j - min_j) for i, j in tetromino_cells[shape][rotation]} == {
+            (i - other_min_i, j - other_min_j) for i, j in tetromino_cells[shape][other]
+        }:
+            return other
+
+
+tetromino_orientations = {
+    shape: tuple(tetromino_orientation(shape, rotation) for rotation in range(4))
+    for shape in shapes
+}
+
+# Tables of Game.placements() by shape and rotation: the rotations with their
+# action, next rotation and wall kicks, and (orientation, lowest row offset,
+# leftmost column offset) telling which landings cover the same cells
+placement_rotations = {
+    shape: tuple(
+        tuple(
+            (action, (rotation + direction) % 4, kicks)
+            for direction, action in ((1, "cw"), (-1, "ccw"))
+            for kicks in [kick_table.get((shape, rotation, (rotation + direction) % 4))]
+            if kicks
+        )
+        for rotation in range(4)
+    )
+    for shape in shapes
+}
+placement_landings = {
+    shape: tuple(
+        (
+            tetromino_orientations[shape][rotation],
+            *tetromino_bounds[shape][rotation][:2],
+        )
+        for rotation in range(4)
+    )
+    for shape in shapes
+}
+
+
+# (column offset, lowest row offset, highest row offset) of each column of
+# the tetromino, the cells of a column are always contiguous
+tetromino_columns = {
+    shape: tuple(
+        tuple(
+            (
+                j,
+                min(i for i, other_j in cells if other_j == j),
+                max(i for i, other_j in cells if other_j == j),
+            )
+            for j in sorted({j for i, j in cells})
+        )
+        for cells in tetromino_cells[shape]
+    )
+    for shape in shapes
+}
+
+# number of cells in each line of tetromino_masks
+tetromino_line_counts = {
+    shape: tuple(
+        tuple((i, bin(mask).count("1")) for i, mask in masks)
+        for masks in tetromino_masks[shape]
+    )
+    for shape in shapes
+}
+
+
+def column_range(shape, rotation, width):
+    # min and max column where the tetromino is inside the walls
+    _, min_j, _, max_j = tetromino_bounds[shape][rotation]
+    return -min_j, width - 1 - max_j
+
+
+placement_limit_tables = {}
+
+
+def placement_limits(width):
+    # (min column, max column, min row) where each placement is in bounds,
+    # computed once per playfield width and shared by the games
+    limits = placement_limit_tables.get(width)
+    if limits is None:
+        limits = placement_limit_tables[width] = {
+            shape: tuple(
+                (
+                    *column_range(shape, rotation, width),
+                    -tetromino_bounds[shape][rotation][0],
+                )
+                for rotation in range(4)
+            )
+            for shape in shapes
+        }
+    return limits
+
+
+# (grid, rows, surface) of the empty playfield of each size
+empty_boards = {}
+
+
+def empty_row_mask(width):
+    return ((1 << row_padding) - 1) | (
+        ((1 << row_padding) - 1) << (width + row_padding)
+    )
+
+
+def full_row_mask(width):
+    return (1 << (width + 2 * row_padding)) - 1
+
+
+def row_mask(line, width):
+    mask = empty_row_mask(width)
+    for x, code in enumerate(line):
+        if code:
+            mask |= 1 << (row_padding + x)
+    return mask
+
+
 class Game:
-    test = False
-    debug_lines = []
-    width = 10
-    visible_height = 20
-    height = visible_height * 2
-    level = 1
-    score = 0
-    paused = False
-    last_movement = None
-    wall_kicked = False
-    game_over = False
-    bag = []
-    current_shape = None
-    current_row = None
-    current_column = None
-    current_rotation = None
-
-    def __init__(self, grid=None):
+    # Games only hold their own state, in slots. An instance dictionary is
+    # only created when a method is overridden on a game (by tests or by
+    # Metrics).
+    __slots__ = (
+        "test",
+        "debug_lines",
+        "width",
+        "visible_height",
+        "height",
+        "level",
+        "score",
+        "paused",
+        "last_movement",
+        "wall_kicked",
+        "game_over",
+        "current_shape",
+        "current_row",
+        "current_column",
+        "current_rotation",
+        "headless",
+        "renderer",
+        "render_scheduler",
+        "recorder",
+        "pending_garbage",
+        "lock_deadline",
+        "lock_resets",
+        "metrics",
+        "metrics_overlay",
+        "line_strings",
+        "garbage_count",
+        "ghost_rows",
+        "ghost_key",
+        "ghost_row",
+        "placement_rows",
+        "placement_board",
+        "last_lines_cleared",
+        "last_t_spin",
+        "lines",
+        "pieces",
+        "t_spins",
+        "bag",
+        "grid",
+        "empty_row",
+        "full_row",
+        "rows",
+        "surface",
+        "placement_limits",
+        "next_shape",
+    )
+
+    def __init__(self, grid=None, headless=False, seed=None):
+        self.test = False
+        self.debug_lines = ()
+        self.level = 1
+        self.score = 0
+        self.lines = 0
+        self.pieces = 0
+        self.t_spins = 0
+        self.paused = False
+        self.game_over = False
+        self.last_movement = None
+        self.wall_kicked = False
+        self.current_shape = None
+        self.current_row = None
+        self.current_column = None
+        self.current_rotation = None
+        self.renderer = None
+        self.render_scheduler = None
+        self.recorder = None
+        self.pending_garbage = 0
+        self.lock_deadline = None
+        self.lock_resets = 0
+        self.metrics = None
+        self.metrics_overlay = False
+        self.line_strings = None
+        self.garbage_count = 0
+        self.ghost_rows = None
+        self.ghost_key = None
+        self.ghost_row = None
+        self.placement_rows = None
+        self.placement_board = None
+        self.last_lines_cleared = 0
+        self.last_t_spin = None
+        self.headless = headless
+        self.bag = Bag(seed)
         if grid is None:
-            self.grid = [[None] * self.width for i in range(self.height)]
+            self.width = 10
+            self.visible_height = 20
+            self.height = self.visible_height * 2
         else:
-            self.grid = grid
+            self.grid = tuple(bytes(line) for line in grid)
             self.height = len(self.grid)
             self.visible_height = self.height // 2
             self.width = len(self.grid[0])
+        # self.grid holds the piece code of each cell (0 when empty) for
+        # rendering, collisions are checked against these row bitmasks. Both
+        # are tuples replaced (not mutated) when a tetromino locks, so
+        # snapshots can share them.
+        self.empty_row = empty_row_mask(self.width)
+        self.full_row = full_row_mask(self.width)
+        if grid is None:
+            # empty boards are shared by the games
+            board = empty_boards.get((self.width, self.height))
+            if board is None:
+                self.grid = (bytes(self.width),) * self.height
+                self.rows = (self.empty_row,) * self.height
+                self.surface = self.compute_surface()
+                board = empty_boards[self.width, self.height] = (
+                    self.grid,
+                    self.rows,
+                    self.surface,
+                )
+            self.grid, self.rows, self.surface = board
+        else:
+            self.rows = tuple(row_mask(line, self.width) for line in self.grid)
+            self.surface = self.compute_surface()
+        self.placement_limits = placement_limits(self.width)
         self.next_shape = self.random_shape()
 
     def move(self, delta):
@@ -401,6 +749,7 @@ class Game:
         ):
             self.current_column = next_column
             self.last_movement = "move"
+            self.reset_lock_delay()
             self.render()
 
     def rotate(self, direction):
@@ -410,7 +759,7 @@ class Game:
             return
         next_rotation = (self.current_rotation + direction) % 4
         for i, wall_kick in enumerate(
-            wall_kicks[self.current_shape][self.current_rotation][next_rotation]
+            kick_table[self.current_shape, self.current_rotation, next_rotation]
         ):
             next_column = self.current_column + wall_kick[0]
             next_row = self.current_row + wall_kick[1]
@@ -421,16 +770,17 @@ class Game:
                 self.current_row = next_row
                 self.current_column = next_column
                 self.last_movement = "rotate"
+                self.reset_lock_delay()
                 self.render()
                 break
         self.wall_kicked = i != 0
 
     def random_shape(self):
-        if len(self.bag) == 0:
-            self.bag = shapes[:]
-        shape = choice(self.bag)
-        self.bag.remove(shape)
-        return shape
+        return next(self.bag)
+
+    def preview(self, count):
+        # The next `count` tetrominoes, without consuming them
+        return [self.next_shape, *self.bag.peek(count - 1)]
 
     def new_tetromino(self):
         self.current_shape = self.next_shape
@@ -439,6 +789,44 @@ class Game:
         self.current_column = current_column
         self.current_row = current_row
         self.current_rotation = 0
+        self.lock_deadline = None
+        self.lock_resets = 0
+
+    def reset_lock_delay(self):
+        # Moving or rotating a tetromino on the ground restarts its lock
+        # delay, a limited number of times
+        if self.lock_deadline is not None and self.lock_resets < max_lock_resets:
+            self.lock_deadline = None
+            self.lock_resets += 1
+
+    def fall(self, rows):
+        # Gravity of the game loop: moves the tetromino down by up to `rows`
+        # rows at once, and locks it once it stayed lock_delay seconds on the
+        # ground. Recorded as single row "gravity" steps, so it replays the
+        # same way.
+        if self.game_over:
+            return StepResult(0, None, 0, True)
+        if self.paused:
+            return StepResult(0, None, 0, False)
+        if self.current_shape is None:
+            self.new_tetromino()
+        distance = self.drop_distance()
+        moved = min(rows, distance)
+        if moved:
+            if self.recorder is not None:
+                for i in range(moved):
+                    self.recorder.record("gravity")
+            self.current_row -= moved
+            self.last_movement = "down"
+            self.lock_deadline = None
+            self.render()
+        if moved == distance:
+            now = monotonic()
+            if self.lock_deadline is None:
+                self.lock_deadline = now + lock_delay
+            elif now >= self.lock_deadline:
+                return self.step("gravity")
+        return StepResult(0, None, 0, False)
 
     def pause(self):
         self.paused = not self.paused
@@ -450,10 +838,7 @@ class Game:
             for j in [0, 2]:
                 r = row + i
                 c = column + j
-                if (
-                    not self.in_bounds(r, c)
-                    or self.grid[row + i][column + j] is not None
-                ):
+                if not self.in_bounds(r, c) or self.rows[r] >> (row_padding + c) & 1:
                     count += 1
         return count
 
@@ -484,14 +869,36 @@ class Game:
                         mini_t_spin = True
                     else:
                         t_spin = True
-            put_tetromino(
-                self.grid,
+            self.lock_tetromino(
                 self.current_shape,
                 self.current_column,
                 self.current_row,
                 self.current_rotation,
             )
-            self.remove_complete_lines(t_spin, mini_t_spin)
+            min_i, _, max_i, _ = tetromino_bounds[self.current_shape][
+                self.current_rotation
+            ]
+            self.remove_complete_lines(
+                t_spin,
+                mini_t_spin,
+                range(self.current_row + min_i, self.current_row + max_i + 1),
+            )
+            self.pieces += 1
+            if self.pending_garbage:
+                if self.last_lines_cleared:
+                    # cleared lines cancel the garbage received meanwhile
+                    self.pending_garbage = max(
+                        0, self.pending_garbage - self.last_lines_cleared
+                    )
+                else:
+                    self.add_garbage(self.pending_garbage)
+                    self.pending_garbage = 0
+            if t_spin:
+                self.last_t_spin = "t_spin"
+                self.t_spins += 1
+            elif mini_t_spin:
+                self.last_t_spin = "mini_t_spin"
+                self.t_spins += 1
             if self.tetromino_touches_ceiling(
                 self.current_shape,
                 self.current_column,
@@ -500,6 +907,8 @@ class Game:
             ):
                 self.game_over = True
             self.new_tetromino()
+            if not hard_drop:
+                self.render()
             return True
         self.current_row -= 1
         self.last_movement = "down"
@@ -510,18 +919,118 @@ class Game:
         else:
             self.render()
 
-    def remove_complete_lines(self, t_spin, mini_t_spin):
-        self.grid[:] = [row for row in self.grid if not all(row)]
-        lines_removed = self.height - len(self.grid)
+    def lock_tetromino(self, shape, column, row, rotation):
+        old_rows = self.rows
+        rows = list(old_rows)
+        shift = column + row_padding
+        heights, holes, wells, row_fills = map(list, self.surface)
+        for i, mask in tetromino_masks[shape][rotation]:
+            # only the cells that were empty change the surface (a tetromino
+            # spawned into a high stack may overlap it)
+            added = (mask << shift) & ~rows[row + i]
+            rows[row + i] |= added
+            row_fills[row + i] += bin(added).count("1")
+        self.rows = tuple(rows)
+        self.grid = put_tetromino(self.grid, shape, column, row, rotation)
+        for j, min_i, max_i in tetromino_columns[shape][rotation]:
+            x = column + j
+            bit = 1 << (row_padding + x)
+            added = [
+                r for r in range(row + min_i, row + max_i + 1) if not old_rows[r] & bit
+            ]
+            if not added:
+                continue
+            height = heights[x]
+            # cells filling holes below the top of the column
+            filled = sum(r < height for r in added)
+            holes[x] -= filled
+            top = added[-1] + 1
+            if top > height:
+                # new holes between the top of the column and the tetromino
+                holes[x] += top - height - (len(added) - filled)
+                heights[x] = top
+        first = max(0, column + tetromino_bounds[shape][rotation][1] - 1)
+        last = min(self.width, column + tetromino_bounds[shape][rotation][3] + 2)
+        wells[first:last] = well_depths(heights, self.height, first, last)
+        self.surface = Surface(
+            tuple(heights), tuple(holes), tuple(wells), tuple(row_fills)
+        )
+
+    def remove_complete_lines(self, t_spin, mini_t_spin, rows=None):
+        # Only the given rows (those where a tetromino just locked) are
+        # checked, all of them by default
+        row_fills = self.surface.row_fills
+        if rows is None:
+            rows = range(self.height)
+        complete = [i for i in rows if row_fills[i] == self.width]
+        if complete:
+            kept = [i for i in range(self.height) if i not in complete]
+            self.rows = (
+                *(self.rows[i] for i in kept),
+                *(self.empty_row for i in complete),
+            )
+            self.grid = (
+                *(self.grid[i] for i in kept),
+                *(bytes(self.width) for i in complete),
+            )
+            heights, holes, wells, row_fills = self.surface
+            new_heights = []
+            new_holes = []
+            for x, (height, column_holes) in enumerate(zip(heights, holes)):
+                # complete rows are below the top of every column
+                filled = height - column_holes - len(complete)
+                height -= len(complete)
+                if height + len(complete) - 1 in complete:
+                    # the top cell was removed, look for the next one
+                    bit = 1 << (row_padding + x)
+                    while height > 0 and not self.rows[height - 1] & bit:
+                        height -= 1
+                new_heights.append(height)
+                new_holes.append(height - filled)
+            self.surface = Surface(
+                tuple(new_heights),
+                tuple(new_holes),
+                tuple(well_depths(new_heights, self.height)),
+                (*(row_fills[i] for i in kept), *(0 for i in complete)),
+            )
+        lines_removed = len(complete)
+        self.last_lines_cleared = lines_removed
+        self.lines += lines_removed
         self.update_score(lines_removed, t_spin, mini_t_spin)
-        while len(self.grid) < self.height:
-            self.grid.append([None] * self.width)
+
+    def receive_garbage(self, lines):
+        # Garbage sent by an opponent, added when the next tetromino locks
+        # without clearing lines
+        self.pending_garbage += lines
+
+    def add_garbage(self, lines, hole=None):
+        # Pushes the board up with garbage lines all having the same hole
+        if hole is None:
+            # the n-th number of a splitmix64 stream of its own, so a restored
+            # game gets the same holes
+            state = (~self.bag.seed + self.garbage_count * 0x9E3779B97F4A7C15) & mask64
+            hole = splitmix64(state)[1] % self.width
+        self.garbage_count += 1
+        lines = min(lines, self.height)
+        if any(mask != self.empty_row for mask in self.rows[self.height - lines :]):
+            self.game_over = True
+        garbage_row = self.full_row ^ (1 << (row_padding + hole))
+        garbage_line = bytes(
+            0 if x == hole else garbage_code for x in range(self.width)
+        )
+        self.rows = (garbage_row,) * lines + self.rows[: self.height - lines]
+        self.grid = (garbage_line,) * lines + self.grid[: self.height - lines]
+        self.surface = self.compute_surface()
 
     def hard_drop(self):
         if self.paused:
             return
-        while not self.move_down(hard_drop=True):
-            pass
+        distance = self.drop_distance()
+        if distance:
+            self.current_row -= distance
+            self.last_movement = "down"
+            self.score += 2 * distance
+        self.move_down(hard_drop=True)
         self.render()
 
     def spawn_position(self, shape):
@@ -533,57 +1042,282 @@ class Game:
         return row >= 0 and column >= 0 and column < self.width
 
     def tetromino_fits(self, shape, column, row, rotation):
-        return all(
-            self.in_bounds(row + i, column + j)
-            and self.grid[row + i][column + j] is None
-            for [i, j] in grid_iterator(shape, column, row, rotation)
-        )
+        min_column, max_column, min_row = self.placement_limits[shape][rotation]
+        if not min_column <= column <= max_column or row < min_row:
+            return False
+        rows = self.rows
+        shift = column + row_padding
+        for i, mask in tetromino_masks[shape][rotation]:
+            if rows[row + i] & (mask << shift):
+                return False
+        return True
 
     def tetromino_touches_ground(self, shape, column, row, rotation):
         return not self.tetromino_fits(shape, column, row - 1, rotation)
 
     def tetromino_touches_ceiling(self, shape, column, row, rotation):
-        return any(
-            row + i == self.visible_height
-            for [i, j] in grid_iterator(shape, column, row, rotation)
+        # tetrominoes have no empty line between their bottom and top cells
+        min_i, _, max_i, _ = tetromino_bounds[shape][rotation]
+        return min_i <= self.visible_height - row <= max_i
+
+    def column_heights(self):
+        return self.surface.heights
+
+    def compute_surface(self, rows=None):
+        # Builds the surface index from scratch, Game.surface is then kept up
+        # to date by lock_tetromino and remove_complete_lines
+        rows = self.rows if rows is None else rows
+        columns = self.column_bitboards(rows)
+        heights = tuple(column.bit_length() - placement_floor for column in columns)
+        return Surface(
+            heights,
+            tuple(
+                height - (bin(column).count("1") - placement_floor)
+                for height, column in zip(heights, columns)
+            ),
+            tuple(well_depths(heights, self.height)),
+            tuple(bin(mask ^ self.empty_row).count("1") for mask in rows),
         )
 
     def get_ghost_row(self):
-        ghost_row = self.current_row
-        while not self.tetromino_touches_ground(
-            self.current_shape, self.current_column, ghost_row, self.current_rotation
-        ):
-            ghost_row -= 1
-        return ghost_row
-
-    def render_grid(self):
-        visible_grid = deepcopy(self.grid)
-        put_tetromino(
-            visible_grid,
-            self.current_shape,
-            self.current_column,
-            self.get_ghost_row(),
-            self.current_rotation,
-            "🮙",
-        )
-        put_tetromino(
-            visible_grid,
+        key = (
             self.current_shape,
             self.current_column,
             self.current_row,
             self.current_rotation,
         )
-        lines = [
-            "".join(
-                (
-                    " " * render_width_multiplier
-                    if cell is None
-                    else color_string(cell[0] * render_width_multiplier, cell[1])
-                    for cell in line
+        if self.ghost_rows is self.rows and self.ghost_key == key:
+            return self.ghost_row
+        heights = self.column_heights()
+        column = self.current_column
+        # Lowest row where every column of the tetromino is above the stack
+        ghost_row = max(
+            heights[column + j] - i
+            for j, i, _ in tetromino_columns[self.current_shape][self.current_rotation]
+        )
+        if ghost_row > self.current_row:
+            # The tetromino is below the top of a column, under an overhang
+            ghost_row = self.current_row
+            while not self.tetromino_touches_ground(
+                self.current_shape, column, ghost_row, self.current_rotation
+            ):
+                ghost_row -= 1
+        self.ghost_rows = self.rows
+        self.ghost_key = key
+        self.ghost_row = ghost_row
+        return ghost_row
+
+    def drop_distance(self):
+        return self.current_row - self.get_ghost_row()
+
+    def column_bitboards(self, rows=None):
+        # One bitmask per column with bit `placement_floor + row` set when the
+        # cell is filled, the bits below are set and act as the floor.
+        columns = [(1 << placement_floor) - 1] * self.width
+        empty_row = self.empty_row
+        for r, mask in enumerate(self.rows if rows is None else rows):
+            if mask == empty_row:
+                continue
+            mask = (mask ^ empty_row) >> row_padding
+            bit = 1 << (r + placement_floor)
+            while mask:
+                low = mask & -mask
+                columns[low.bit_length() - 1] |= bit
+                mask ^= low
+        return columns
+
+    def rows_after(self, shape, column, row, rotation, rows=None):
+        # The rows once the tetromino is locked and complete lines removed,
+        # with the number of removed lines
+        rows = list(self.rows if rows is None else rows)
+        shift = column + row_padding
+        for i, mask in tetromino_masks[shape][rotation]:
+            rows[row + i] |= mask << shift
+        full_row = self.full_row
+        if full_row not in rows:
+            return rows, 0
+        kept = [mask for mask in rows if mask != full_row]
+        lines_removed = len(rows) - len(kept)
+        kept.extend([self.empty_row] * lines_removed)
+        return kept, lines_removed
+
+    def placements(self, shape=None, rows=None):
+        # Every position where a tetromino can lock, reachable from its
+        # spawn position (or from the current position for the current
+        # tetromino) with moves, rotations and drops. Positions covering the
+        # same cells are only listed once, with the best t-spin kind among
+        # the ways to get there. rows can be given to search another board.
+        if shape is None:
+            shape = self.current_shape
+            start = (self.current_column, self.current_row, self.current_rotation)
+        else:
+            start = (*self.spawn_position(shape), 0)
+        floor = placement_floor
+        offset = placement_column_offset
+        width = self.width
+        rows = self.rows if rows is None else rows
+        # The tables of a board are cached until its rows are replaced, like
+        # the ghost row, the beam search asks for several shapes on each
+        if self.placement_rows is not rows:
+            columns = self.column_bitboards(rows)
+            top = max(column.bit_length() for column in columns) - floor
+            # column bitboards with walls around, indexed by column + offset
+            walls = [-1] * offset + columns + [-1] * offset
+            self.placement_rows = rows
+            self.placement_board = (columns, walls, top, {})
+        columns, walls, top, shape_collisions = self.placement_board
+        # collisions[rotation][column + offset] has bit `floor + row` set when
+        # the tetromino does not fit at this row
+        collisions = shape_collisions.get(shape)
+        if collisions is None:
+            collisions = shape_collisions[shape] = []
+            for cells in tetromino_cells[shape]:
+                rotation_collisions = []
+                for column in range(-offset, width + offset):
+                    collision = 0
+                    for i, j in cells:
+                        if not 0 <= column + j < width:
+                            collision = -1
+                            break
+                        collision |= columns[column + j] >> i
+                    rotation_collisions.append(collision)
+                collisions.append(rotation_collisions)
+        # Above this row a tetromino and its wall kicks (2 rows at most) only
+        # meet the walls, it moves and rotates the same at any height there
+        # so it is dropped straight to this row before moving, and dropped
+        # back to it when kicked up. Below it, it is dropped one row at a time
+        # so that every move and kick made on the way down is tried.
+        air_row = top + 2
+        column, row, rotation = start
+        if collisions[rotation][column + offset] >> (row + floor) & 1:
+            return []
+        rotations = placement_rotations[shape]
+        landing_keys = placement_landings[shape]
+        # state: (column, row, rotation) -> (previous state, action, count)
+        parents = {start: None}
+        # landed cells -> [spin rank, state, previous state, action, count]
+        landings = {}
+        if row > air_row:
+            state = (column, air_row, rotation)
+            parents[state] = (start, "soft", row - air_row)
+            queue = [state]
+        else:
+            queue = [start]
+        for state in queue:
+            column, row, rotation = state
+            x = column + offset
+            y = row + floor
+            rotation_collisions = collisions[rotation]
+            if rotation_collisions[x] >> (y - 1) & 1:
+                # landed, first reached without a spin
+                orientation, min_i, min_j = landing_keys[rotation]
+                key = (orientation, row + min_i, column + min_j)
+                if key not in landings:
+                    landings[key] = [0, state, *(parents[state] or (None, None, 0))]
+            else:
+                next_state = (column, row - 1, rotation)
+                if next_state not in parents:
+                    parents[next_state] = (state, "soft", 1)
+                    queue.append(next_state)
+            if not rotation_collisions[x - 1] >> y & 1:
+                next_state = (column - 1, row, rotation)
+                if next_state not in parents:
+                    parents[next_state] = (state, "left", 1)
+                    queue.append(next_state)
+            if not rotation_collisions[x + 1] >> y & 1:
+                next_state = (column + 1, row, rotation)
+                if next_state not in parents:
+                    parents[next_state] = (state, "right", 1)
+                    queue.append(next_state)
+            for action, next_rotation, kicks in rotations[rotation]:
+                next_collisions = collisions[next_rotation]
+                for i, (dx, dy) in enumerate(kicks):
+                    next_x = x + dx
+                    next_y = y + dy
+                    if next_collisions[next_x] >> next_y & 1:
+                        continue
+                    next_state = (column + dx, row + dy, next_rotation)
+                    if next_state not in parents:
+                        if row + dy > air_row:
+                            # kicked up in the air, falls back to air_row
+                            parents[next_state] = (state, action, 1)
+                            air_state = (column + dx, air_row, next_rotation)
+                            if air_state not in parents:
+                                parents[air_state] = (
+                                    next_state,
+                                    "soft",
+                                    row + dy - air_row,
+                                )
+                                queue.append(air_state)
+                            break
+                        parents[next_state] = (state, action, 1)
+                        queue.append(next_state)
+                    # same rules as move_down and t_corner_count, a rotation
+                    # landing with 3 corners filled is a spin
+                    if (
+                        next_collisions[next_x] >> (next_y - 1) & 1
+                        and (
+                            (walls[next_x] >> next_y & 1)
+                            + (walls[next_x + 2] >> next_y & 1)
+                            + (walls[next_x] >> (next_y + 2) & 1)
+                            + (walls[next_x + 2] >> (next_y + 2) & 1)
+                        )
+                        >= 3
+                    ):
+                        spin_rank = 1 if i else 2
+                        orientation, min_i, min_j = landing_keys[next_rotation]
+                        key = (orientation, row + dy + min_i, column + dx + min_j)
+                        landing = landings.get(key)
+                        if landing is None or spin_rank > landing[0]:
+                            landings[key] = [spin_rank, next_state, state, action, 1]
+                    break
+
+        result = []
+        for spin_rank, state, previous, action, count in landings.values():
+            path = [action] * count
+            while previous is not None and parents[previous] is not None:
+                previous, action, count = parents[previous]
+                path.extend([action] * count)
+            path.reverse()
+            path.append("hard")
+            result.append(Placement(*state, spin_kinds[spin_rank], tuple(path)))
+        return result
+
+    def render_grid(self):
+        # Each line of the grid is rendered once and cached with the strings
+        # of its cells until its tuple is replaced. The ghost and the current
+        # tetromino are drawn over copies of these strings.
+        overlay = {}
+        code = piece_codes[self.current_shape]
+        cells = tetromino_cells[self.current_shape][self.current_rotation]
+        for row, strings in (
+            (self.get_ghost_row(), ghost_strings),
+            (self.current_row, block_strings),
+        ):
+            string = strings[code]
+            for i, j in cells:
+                overlay.setdefault(row + i, []).append(
+                    (self.current_column + j, string)
                 )
-            )
-            for line in list(reversed(visible_grid))[self.visible_height :]
-        ]
+        line_strings = self.line_strings
+        if line_strings is None:
+            line_strings = self.line_strings = [
+                (None, None, None)
+            ] * self.visible_height
+        lines = []
+        for r in reversed(range(self.visible_height)):
+            line = self.grid[r]
+            cached, strings, string = line_strings[r]
+            if cached is not line:
+                strings = [block_strings[code] for code in line]
+                string = "".join(strings)
+                line_strings[r] = (line, strings, string)
+            if r in overlay:
+                strings = strings.copy()
+                for c, cell in overlay[r]:
+                    strings[c] = cell
+                string = "".join(strings)
+            lines.append(string)
         return frame(lines, "", self.width * render_width_multiplier)
 
     def render_preview(self):
@@ -606,65 +1340,255 @@ class Game:
             for tetromino_line in next_tetromino[:2]
         ]
 
-    def render(self, clr=True):
-        lines = self.render_grid()
+    def render(self):
+        if self.headless:
+            return
+        if self.render_scheduler is None:
+            self.draw()
+        else:
+            self.render_scheduler.request()
+
+    def draw(self):
+        self.write(self.render_panels(self.render_grid()))
+
+    def render_panels(self, lines):
         render_side(lines, 0, "next", self.render_preview(), 8)
         render_side(lines, 4, "score", ["{:>8}".format(self.score)])
         render_side(lines, 7, "level", ["{:>8}".format(self.level)])
         render_side(lines, 10, "controls", controls)
         if self.paused:
             lines[20] += " PAUSED"
-        if not self.test:
-            clear()
         lines += self.debug_lines
-        print("\n".join(lines))
-        if not self.test:
-            hide_cursor()
+        if self.metrics_overlay:
+            lines += self.metrics.overlay()
+        return lines
+
+    def write(self, lines):
+        if self.test:
+            print("\n".join(lines))
+            return
+        if self.renderer is None:
+            self.renderer = Renderer(stdout)
+        self.renderer.draw(lines)
+
+    def toggle_metrics(self):
+        # Metrics are collected while the overlay shows them or when they
+        # are exported
+        self.metrics_overlay = not self.metrics_overlay
+        if self.metrics is None:
+            Metrics().attach(self)
+        elif not self.metrics_overlay and self.metrics.file is None:
+            self.metrics.detach(self)
+        self.render()
+
+    def redraw(self):
+        if self.renderer is not None:
+            self.renderer.invalidate()
+        self.draw()
+
+    def step(self, action):
+        # Applies one of the actions to the game and returns what it caused,
+        # see step_actions. Headless games never render nor wait.
+        if self.game_over:
+            return StepResult(0, None, 0, True)
+        if self.current_shape is None:
+            self.new_tetromino()
+        if self.recorder is not None:
+            self.recorder.record(action)
+        score = self.score
+        self.last_lines_cleared = 0
+        self.last_t_spin = None
+        step_actions[action](self)
+        return StepResult(
+            self.last_lines_cleared,
+            self.last_t_spin,
+            self.score - score,
+            self.game_over,
+        )
+
+    def snapshot(self):
+        # The board is immutable so this doesn't copy anything
+        return GameState(
+            self.rows,
+            self.grid,
+            self.bag.getstate(),
+            *(getattr(self, field) for field in GameState._fields[3:]),
+        )
+
+    def restore(self, state):
+        self.rows = state.rows
+        self.grid = state.grid
+        self.bag.setstate(state.bag)
+        for field in GameState._fields[3:]:
+            setattr(self, field, getattr(state, field))
+
+    def grid_hash(self):
+        from hashlib import blake2b
+
+        row_size = (self.width + 2 * row_padding + 7) // 8
+        return blake2b(
+            b"".join(mask.to_bytes(row_size, "little") for mask in self.rows),
+            digest_size=8,
+        ).digest()
 
     def interval(self):
         return (0.8 - ((self.level - 1) * 0.007)) ** (self.level - 1)
 
+    def gravity(self):
+        # Rows per frame, 1G being a row each frame and 20G the whole
+        # playfield at once
+        return min(max_gravity, 1 / (self.interval() * gravity_frame_rate))
+
     def debug(self, *args):
-        self.debug_lines.append(" ".join(map(str, args)))
-        self.debug_lines = self.debug_lines[-5:]
+        # Rebinds instead of appending to not share the class level lines
+        self.debug_lines = [*self.debug_lines[-4:], " ".join(map(str, args))]
 
     async def timer(self):
-        target_time = time()
+        # Yields how many rows the tetromino falls, at most once per frame
+        # whatever the level, or when its lock delay ends
+        from asyncio import sleep
+
+        frame = 1 / gravity_frame_rate
+        rows = 0
+        last_tick = monotonic()
         while not self.game_over:
-            target_time += self.interval()
-            await sleep(target_time - time())
+            rows_per_second = self.gravity() * gravity_frame_rate
+            delay = max(frame, (1 - rows) / rows_per_second)
+            if self.lock_deadline is not None:
+                delay = min(delay, self.lock_deadline - last_tick)
+            await sleep(delay)
             if self.game_over:
                 break
-            yield
+            now = monotonic()
+            if self.metrics is not None:
+                self.metrics.add("timer.jitter", now - last_tick - delay)
+            rows += (now - last_tick) * rows_per_second
+            last_tick = now
+            whole_rows = int(rows)
+            rows -= whole_rows
+            if rows_per_second >= max_gravity * gravity_frame_rate:
+                # 20G drops the tetromino on the ground at once
+                whole_rows = self.height
+            yield whole_rows
+
+
+# Read-only index of the board kept up to date by Game: number of rows up to
+# the top filled cell, empty cells below it and well depth of each column,
+# and number of filled cells of each row.
+Surface = namedtuple("Surface", ["heights", "holes", "wells", "row_fills"])
+
+# Gravity is counted in rows per frame of this rate
+gravity_frame_rate = 60
+max_gravity = 20
+# Seconds a tetromino stays on the ground before locking, and how many times
+# moving or rotating it restarts this delay
+lock_delay = 0.5
+max_lock_resets = 15
+
+
+def well_depths(heights, wall_height, first=0, last=None):
+    # How deep each column is below the lowest of its neighbours, the walls
+    # being as high as the playfield
+    if last is None:
+        last = len(heights)
+    padded = (wall_height, *heights, wall_height)
+    depths = []
+    for x in range(first, last):
+        left = padded[x]
+        right = padded[x + 2]
+        lowest = left if left < right else right
+        depths.append(lowest - padded[x + 1] if lowest > padded[x + 1] else 0)
+    return depths
+
+
+# Everything needed to resume a game, see Game.snapshot()
+GameState = namedtuple(
+    "GameState",
+    [
+        "rows",
+        "grid",
+        "bag",
+        "surface",
+        "next_shape",
+        "current_shape",
+        "current_column",
+        "current_row",
+        "current_rotation",
+        "last_movement",
+        "wall_kicked",
+        "score",
+        "level",
+        "lines",
+        "pieces",
+        "t_spins",
+        "pending_garbage",
+        "garbage_count",
+        "paused",
+        "game_over",
+    ],
+)
 
+StepResult = namedtuple(
+    "StepResult", ["lines_cleared", "t_spin", "score_delta", "game_over"]
+)
 
-def color_string(text, color):
-    return "\x1b[48;2;{};{};{}m{}\x1b[0m".format(*color, text)
+# rows below the bottom of the playfield in Game.column_bitboards()
+placement_floor = 4
+# columns outside of the playfield that Game.placements() may look at
+placement_column_offset = 4
+
+Placement = namedtuple("Placement", ["column", "row", "rotation", "t_spin", "path"])
+
+spin_kinds = (None, "mini_t_spin", "t_spin")
+
+step_actions = {
+    "left": lambda game: game.move(-1),
+    "right": lambda game: game.move(1),
+    "cw": lambda game: game.rotate(1),
+    "ccw": lambda game: game.rotate(-1),
+    "soft": lambda game: game.move_down(soft_drop=True),
+    "hard": lambda game: game.hard_drop(),
+    "gravity": lambda game: game.move_down(),
+    "pause": lambda game: game.pause(),
+    "quit": lambda game: setattr(game, "game_over", True),
+}
 
 
-def tetromino_width(shape):
-    return len(tetrominoes[shape][0][0])
+def color_string(text, color):
+    return "\x1b[48;2;{};{};{}m{}\x1b[0m".format(*color, text)
 
 
-def grid_iterator(shape, column, row, rotation):
-    for i, line in enumerate(reversed(tetrominoes[shape][rotation])):
-        for j, cell in enumerate(line):
-            if cell:
-                yield [i, j]
+def code_strings(character):
+    # The rendered string of each piece code
+    return tuple(
+        " " * render_width_multiplier
+        if color is None
+        else color_string(character * render_width_multiplier, color)
+        for color in code_colors
+    )
 
 
-def put_tetromino(grid, shape, column, row, rotation, character=" "):
-    for [i, j] in grid_iterator(shape, column, row, rotation):
-        grid[row + i][column + j] = (character, tetromino_colors[shape])
+block_strings = code_strings(" ")
+ghost_strings = code_strings("🮙")
 
 
-def clear():
-    print("\x1bc")
+def tetromino_width(shape):
+    return len(tetrominoes[shape][0][0])
 
 
-def hide_cursor():
-    stdout.write("\033[?25l")
-    stdout.flush()
+def put_tetromino(grid, shape, column, row, rotation):
+    # Returns a new grid with the tetromino, sharing the untouched lines
+    code = piece_codes[shape]
+    grid = list(grid)
+    lines = {}
+    for i, j in tetromino_cells[shape][rotation]:
+        line = lines.get(row + i)
+        if line is None:
+            line = lines[row + i] = bytearray(grid[row + i])
+        line[column + j] = code
+    for r, line in lines.items():
+        grid[r] = bytes(line)
+    return tuple(grid)
 
 
 def show_cursor():
@@ -691,26 +1615,471 @@ def render_side(lines, n, title, data, width=None):
         lines[n + i] += " " + line
 
 
+# Draws frames on a terminal, only repainting the cells that changed since the
+# previous frame with cursor addressed updates sent in a single write. The
+# whole screen is only repainted on the first frame, when the terminal is
+# resized, after a failed write or after invalidate() (CTRL+L).
+class Renderer:
+    def __init__(self, stream):
+        from re import compile as re_compile
+
+        self.stream = stream
+        # A cell is either a single character or a colored run of characters,
+        # an escape sequence is never split from the text it colors.
+        self.cell_pattern = re_compile("\x1b\\[[0-9;]*m[^\x1b]*\x1b\\[0m|.")
+        self.escape_pattern = re_compile("\x1b\\[[0-9;]*m")
+        self.previous = None
+        self.size = None
+        self.widths = {}
+
+    def invalidate(self):
+        self.previous = None
+
+    def terminal_size(self):
+        try:
+            return get_terminal_size(self.stream.fileno())
+        except (AttributeError, OSError, ValueError):
+            return None
+
+    def split(self, line):
+        # Returns the cells of a line and the column where each one starts,
+        # followed by the column right after the last cell
+        cells = tuple(self.cell_pattern.findall(line))
+        columns = []
+        column = 1
+        widths = self.widths
+        escape_pattern = self.escape_pattern
+        for cell in cells:
+            columns.append(column)
+            width = widths.get(cell)
+            if width is None:
+                width = widths[cell] = len(escape_pattern.sub("", cell))
+            column += width
+        columns.append(column)
+        return cells, columns
+
+    def draw(self, lines):
+        size = self.terminal_size()
+        if size != self.size:
+            self.size = size
+            self.previous = None
+        rows = [self.split(line) for line in lines]
+        if self.previous is None:
+            output = self.repaint(rows)
+        else:
+            output = self.diff(self.previous, rows)
+        self.previous = rows
+        if output:
+            # the cursor is left below the frame, where later prints go
+            output += "\x1b[{};1H".format(len(rows) + 1)
+            try:
+                self.stream.write(output)
+                self.stream.flush()
+            except BlockingIOError:
+                # Part of the frame may be missing, start over on the next one
+                self.previous = None
+
+    def repaint(self, rows):
+        return "".join(
+            (
+                "\x1b[?25l\x1b[H\x1b[2J",
+                *(
+                    "\x1b[{};1H{}".format(y, "".join(cells))
+                    for y, (cells, columns) in enumerate(rows, 1)
+                ),
+            )
+        )
+
+    def diff(self, previous, rows):
+        output = []
+        for y, (cells, columns) in enumerate(rows, 1):
+            if y > len(previous):
+                output.append("\x1b[{};1H{}".format(y, "".join(cells)))
+                continue
+            old_cells, old_columns = previous[y - 1]
+            if cells == old_cells:
+                continue
+            for start, end in changed_runs(cells, columns, old_cells, old_columns):
+                output.append(
+                    "\x1b[{};{}H{}".format(y, columns[start], "".join(cells[start:end]))
+                )
+            if old_columns[-1] > columns[-1]:
+                output.append("\x1b[{};{}H\x1b[K".format(y, columns[-1]))
+        for y in range(len(rows) + 1, len(previous) + 1):
+            output.append("\x1b[{};1H\x1b[K".format(y))
+        return "".join(output)
+
+
+def changed_runs(cells, columns, old_cells, old_columns):
+    # Yields the (start, end) ranges of cells that differ from the cells
+    # drawn at the same columns in the previous frame. Cells can have
+    # different widths so both rows are walked by column.
+    i = j = 0
+    n = len(cells)
+    m = len(old_cells)
+    while i < n:
+        while j < m and old_columns[j] < columns[i]:
+            j += 1
+        if j < m and old_columns[j] == columns[i] and old_cells[j] == cells[i]:
+            i += 1
+            j += 1
+            continue
+        start = i
+        i += 1
+        while i < n:
+            while j < m and old_columns[j] < columns[i]:
+                j += 1
+            if j < m and old_columns[j] == columns[i] and old_cells[j] == cells[i]:
+                break
+            i += 1
+        yield start, i
+
+
+def timed_method(name, function):
+    def timed(game, *args, **kwargs):
+        start = perf_counter()
+        try:
+            return function(game, *args, **kwargs)
+        finally:
+            game.metrics.add(name, perf_counter() - start)
+
+    return timed
+
+
+class Metrics:
+    # Rolling samples of the durations of the game phases, in seconds. Games
+    # are only timed while metrics are attached to them, by switching them to
+    # a subclass wrapping their methods, so they cost nothing otherwise.
+    timed_methods = {
+        "render_grid": "render.grid",
+        "render_panels": "render.format",
+        "write": "render.write",
+        "move_down": "move_down",
+        "lock_tetromino": "lock",
+        "remove_complete_lines": "line_clear",
+    }
+    timed_classes = {}
+    overlay_interval = 0.5
+
+    def __init__(self, file=None, size=1000):
+        # `file` is where the summary is exported as JSON on exit
+        self.file = file
+        self.size = size
+        self.samples = {}
+        self.overlay_lines = []
+        self.overlay_time = None
+
+    def add(self, name, seconds):
+        samples = self.samples.get(name)
+        if samples is None:
+            samples = self.samples[name] = deque(maxlen=self.size)
+        samples.append(seconds)
+
+    @classmethod
+    def timed_class(cls, game_class):
+        # The subclass of game_class timing its methods, that attached games
+        # are switched to
+        timed = cls.timed_classes.get(game_class)
+        if timed is None:
+            namespace = {"__slots__": ()}
+            for method, name in cls.timed_methods.items():
+                namespace[method] = timed_method(name, getattr(game_class, method))
+            timed = cls.timed_classes[game_class] = type(
+                "Timed" + game_class.__name__, (game_class,), namespace
+            )
+        return timed
+
+    def attach(self, game):
+        if type(game) not in self.timed_classes.values():
+            game.__class__ = self.timed_class(type(game))
+        if game.render_scheduler is not None:
+            self.samples["input.latency"] = game.render_scheduler.input_latencies
+        game.metrics = self
+
+    def detach(self, game):
+        if type(game) in self.timed_classes.values():
+            game.__class__ = type(game).__base__
+        game.metrics = None
+
+    def summary(self):
+        # Milliseconds percentiles of each phase
+        return {
+            name: dict(
+                count=len(samples),
+                **{
+                    "p{}_ms".format(rank): round(seconds * 1000, 4)
+                    for rank, seconds in zip(
+                        (50, 90, 99, 100), percentiles(samples, (50, 90, 99, 100))
+                    )
+                },
+            )
+            for name, samples in self.samples.items()
+            if samples
+        }
+
+    def overlay(self):
+        now = monotonic()
+        if (
+            self.overlay_time is None
+            or now - self.overlay_time >= self.overlay_interval
+        ):
+            self.overlay_time = now
+            self.overlay_lines = [
+                "{:<14}{:>8}{:>8}{:>8} ms".format("", "p50", "p99", "max"),
+                *(
+                    "{:<14}{:>8.2f}{:>8.2f}{:>8.2f}".format(
+                        name, stats["p50_ms"], stats["p99_ms"], stats["p100_ms"]
+                    )
+                    for name, stats in self.summary().items()
+                ),
+            ]
+        return self.overlay_lines
+
+    def export(self):
+        from json import dump
+
+        dump(self.summary(), self.file, indent=2)
+        self.file.write("\n")
+
+
+# Coalesces the render requests of a game: state changes only mark the game
+# dirty and a single task draws it (or calls `draw`) at most once per
+# 1 / fps seconds.
+class RenderScheduler:
+    def __init__(self, game, fps=60, draw=None):
+        from asyncio import Event
+
+        self.game = game
+        self.draw = game.draw if draw is None else draw
+        self.frame_interval = 1 / fps
+        self.dirty = False
+        self.wakeup = Event()
+        self.frames_rendered = 0
+        self.frames_coalesced = 0
+        self.stopped = False
+        # seconds from each key read to the frame showing what it changed
+        self.input_latencies = deque(maxlen=1000)
+        self.input_time = None
+
+    def request(self):
+        if self.dirty:
+            self.frames_coalesced += 1
+        else:
+            self.dirty = True
+            self.wakeup.set()
+
+    def mark_input(self, time):
+        if self.input_time is None:
+            self.input_time = time
+
+    def flush(self):
+        if self.dirty:
+            self.dirty = False
+            self.draw()
+            self.frames_rendered += 1
+            if self.input_time is not None:
+                self.input_latencies.append(monotonic() - self.input_time)
+                self.input_time = None
+
+    def stop(self):
+        self.stopped = True
+        self.wakeup.set()
+
+    async def run(self):
+        from asyncio import sleep
+
+        last_frame = 0
+        while True:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+            if self.stopped:
+                break
+            delay = last_frame + self.frame_interval - monotonic()
+            if delay > 0:
+                await sleep(delay)
+            last_frame = monotonic()
+            self.flush()
+
+
+class GravityTimer:
+    # The gravity of a game driven by a GravityWheel, like Game.timer
+    __slots__ = (
+        "game",
+        "fall",
+        "rows",
+        "rows_per_second",
+        "last_tick",
+        "deadline",
+        "due",
+    )
+
+    def __init__(self, game, fall, now):
+        self.game = game
+        self.fall = fall
+        self.rows = 0
+        self.rows_per_second = None
+        self.last_tick = now
+        self.deadline = None
+        # the wheel slot it waits in, None once removed
+        self.due = None
+
+
+class GravityWheel:
+    # Drives the gravity of many games from one task, instead of a Game.timer
+    # and its own sleep per game. Time is cut in slots of one frame, each game
+    # waits in the slot it is due in and the games due in a slot fall
+    # together, the wheel wrapping around after `size` slots. A game's
+    # gravity, lock deadline and pause are read when it is due, so level or
+    # interval() changes and pauses don't move anything around the wheel.
+    # reschedule() applies them at once by adding a new entry when the due
+    # slot changes, the old one is left behind and skipped when its slot
+    # comes. How late the wheel wakes
+    # up (its lag) is sampled on each slot.
+    def __init__(self, size=128, resolution=1 / gravity_frame_rate):
+        from asyncio import Event
+
+        self.resolution = resolution
+        self.slots = [[] for _ in range(size)]
+        self.timers = {}
+        self.start = monotonic()
+        # the last slot processed, counted from start
+        self.current = 0
+        self.wakeup = Event()
+        self.lags = deque(maxlen=1000)
+        self.ticks = 0
+        self.batches = 0
+
+    def slot(self, time):
+        return int((time - self.start) / self.resolution)
+
+    def add(self, game, fall=None):
+        # `fall` gets the rows the tetromino falls, game.fall by default
+        now = monotonic()
+        timer = GravityTimer(game, game.fall if fall is None else fall, now)
+        self.timers[game] = timer
+        self.schedule(timer)
+        self.wakeup.set()
+        return timer
+
+    def remove(self, game):
+        timer = self.timers.pop(game, None)
+        if timer is not None:
+            timer.due = None
+
+    def reschedule(self, game):
+        timer = self.timers.get(game)
+        if timer is not None:
+            self.schedule(timer)
+
+    def schedule(self, timer):
+        game = timer.game
+        frame = 1 / gravity_frame_rate
+        timer.rows_per_second = game.gravity() * gravity_frame_rate
+        delay = max(frame, (1 - timer.rows) / timer.rows_per_second)
+        if game.lock_deadline is not None:
+            delay = min(delay, game.lock_deadline - timer.last_tick)
+        timer.deadline = timer.last_tick + delay
+        # rounded up so that games are never due early
+        due = -int((self.start - timer.deadline) // self.resolution)
+        due = max(due, self.current + 1)
+        if due != timer.due:
+            # an unchanged due keeps its entry, a second one would tick twice
+            timer.due = due
+            self.slots[due % len(self.slots)].append((due, timer))
+
+    def tick(self, timer, now):
+        game = timer.game
+        if game.game_over:
+            self.remove(game)
+            return
+        if game.metrics is not None:
+            game.metrics.add("timer.jitter", now - timer.deadline)
+        if game.paused:
+            # the tetromino falls from where it stopped once resumed
+            timer.last_tick = now
+            self.schedule(timer)
+            return
+        timer.rows += (now - timer.last_tick) * timer.rows_per_second
+        timer.last_tick = now
+        rows = int(timer.rows)
+        timer.rows -= rows
+        if timer.rows_per_second >= max_gravity * gravity_frame_rate:
+            # 20G drops the tetromino on the ground at once
+            rows = game.height
+        timer.fall(rows)
+        if self.timers.get(game) is not timer:
+            # removed while falling
+            return
+        if game.game_over:
+            self.remove(game)
+        else:
+            self.schedule(timer)
+
+    def advance(self, slot, now):
+        # Ticks the games due in the slot, keeping the later entries and
+        # dropping the stale ones
+        index = slot % len(self.slots)
+        entries = self.slots[index]
+        if not entries:
+            return
+        self.slots[index] = [
+            (due, timer) for due, timer in entries if due > slot and timer.due == due
+        ]
+        due = [timer for due, timer in entries if due == slot and timer.due == due]
+        if due:
+            self.batches += 1
+            self.ticks += len(due)
+            for timer in due:
+                self.tick(timer, now)
+
+    async def run(self):
+        from asyncio import sleep
+
+        while True:
+            if not self.timers:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                # nothing was due while the wheel was empty
+                self.current = max(self.current, self.slot(monotonic()) - 1)
+            due_time = self.start + (self.current + 1) * self.resolution
+            # sleeps even when late to let the games' other tasks run
+            await sleep(max(0, due_time - monotonic()))
+            now = monotonic()
+            self.lags.append(max(0, now - due_time))
+            # the slots missed while the loop was busy are caught up at once
+            last = max(self.current + 1, self.slot(now))
+            for slot in range(self.current + 1, last + 1):
+                self.current = slot
+                self.advance(slot, now)
+
+    def report(self):
+        if not self.lags:
+            return "gravity lag: no samples"
+        return (
+            "gravity lag p50 {:.1f} ms, p99 {:.1f} ms, max {:.1f} ms, "
+            "{:.1f} games per tick".format(
+                *(t * 1000 for t in percentiles(self.lags)),
+                self.ticks / max(1, self.batches),
+            )
+        )
+
+
 controls = (
-    dedent(
-        """
-            🠅: rotate cw
-            🠄: left
-            🠆: right
-            🠇: soft drop
-            x rotate ccw
-            ␣: hard drop
-            p: pause
-            q: quit
-        """
-    )
-    .strip()
-    .split("\n")
+    "🠅: rotate cw",
+    "🠄: left",
+    "🠆: right",
+    "🠇: soft drop",
+    "x rotate ccw",
+    "␣: hard drop",
+    "p: pause",
+    "q: quit",
 )
 
 
 @contextmanager
 def raw_mode(file):
+    from termios import ECHO, ICANON, TCSADRAIN, tcgetattr, tcsetattr
+
     old_attrs = tcgetattr(file.fileno())
     new_attrs = old_attrs[:]
     new_attrs[3] = new_attrs[3] & ~(ECHO | ICANON)
@@ -725,56 +2094,725 @@ def level_goal(level):
     return sum(range(level + 1)) * 500
 
 
-async def handle_input(game):
-    q = []
-    with raw_mode(stdin):
-        reader = StreamReader()
-        loop = get_event_loop()
-        await loop.connect_read_pipe(lambda: StreamReaderProtocol(reader), stdin)
-        while not reader.at_eof():
-            ch = await reader.read(1)
-            # '' means EOF, chr(4) means EOT (sent by CTRL+D on UNIX terminals)
-            if not ch or ord(ch) <= 4:
+# Decoding table of the keys read from the terminal, from each state of the
+# decoder and each byte to the next state and the action of the key if the
+# byte ends one. Arrows are sent as CSI (ESC [) or SS3 (ESC O) sequences,
+# possibly with modifier parameters.
+arrow_actions = {b"A": "cw", b"B": "soft", b"C": "right", b"D": "left"}
+key_table = {
+    "ground": {
+        b"q"[0]: ("ground", "quit"),
+        b"p"[0]: ("ground", "pause"),
+        # CTRL+L
+        0x0C: ("ground", "redraw"),
+        b"m"[0]: ("ground", "metrics"),
+        b"x"[0]: ("ground", "ccw"),
+        b" "[0]: ("ground", "hard"),
+        0x1B: ("escape", None),
+    },
+    "escape": {b"["[0]: ("csi", None), b"O"[0]: ("ss3", None)},
+    "csi": {
+        **{byte: ("csi", None) for byte in b"0123456789;"},
+        **{key[0]: ("ground", action) for key, action in arrow_actions.items()},
+    },
+    "ss3": {key[0]: ("ground", action) for key, action in arrow_actions.items()},
+}
+
+
+class Keyboard:
+    # Reads every byte available at once and calls on_action(action, time)
+    # for each key, time being when it was read.
+    #
+    # Terminals only send key presses, a held key being pressed again every
+    # few tens of milliseconds after their own repeat delay. Such fast
+    # repeats of left, right or soft drop coming das seconds or more after
+    # the first press start our own auto repeat every arr seconds (0 moves
+    # as far as possible), until no repeat came for release_timeout seconds.
+    repeated_actions = ("left", "right", "soft")
+    max_instant_repeats = 40
+
+    def __init__(
+        self, on_action, das=0.167, arr=0.033, hold_timeout=0.6, release_timeout=0.1
+    ):
+        self.on_action = on_action
+        self.das = das
+        self.arr = arr
+        self.hold_timeout = hold_timeout
+        self.release_timeout = release_timeout
+        self.state = "ground"
+        self.held = None
+        self.pressed_at = 0
+        self.last_seen = 0
+        self.repeater = None
+
+    def feed(self, data, now):
+        # Returns False on EOF or EOT (sent by CTRL+D on UNIX terminals)
+        for byte in data:
+            transition = key_table[self.state].get(byte)
+            if transition is None and self.state != "ground":
+                # an unknown sequence, the byte may start the next one
+                transition = key_table["ground"].get(byte)
+            if transition is None:
+                if byte <= 4:
+                    return False
+                self.state = "ground"
+                continue
+            self.state, action = transition
+            if action is not None:
+                self.press(action, now)
+        return True
+
+    def press(self, action, now):
+        if action not in self.repeated_actions:
+            self.release()
+            self.on_action(action, now)
+            return
+        gap = now - self.last_seen
+        self.last_seen = now
+        if action != self.held or gap >= self.hold_timeout:
+            self.release()
+            self.held = action
+            self.pressed_at = now
+        elif self.repeater is not None:
+            return
+        elif gap < self.release_timeout and now - self.pressed_at >= self.das:
+            from asyncio import create_task
+
+            self.repeater = create_task(self.repeat(action))
+            return
+        self.on_action(action, now)
+
+    def release(self):
+        if self.repeater is not None:
+            self.repeater.cancel()
+            self.repeater = None
+        self.held = None
+
+    async def repeat(self, action):
+        from asyncio import current_task, sleep
+
+        try:
+            while monotonic() - self.last_seen < self.release_timeout:
+                now = monotonic()
+                if self.arr:
+                    self.on_action(action, now)
+                    await sleep(self.arr)
+                else:
+                    for i in range(self.max_instant_repeats):
+                        self.on_action(action, now)
+                    await sleep(self.release_timeout / 2)
+        finally:
+            if self.repeater is current_task():
+                self.repeater = None
+
+    async def run(self, file):
+        from asyncio import StreamReader, StreamReaderProtocol, get_event_loop
+
+        with raw_mode(file):
+            reader = StreamReader()
+            loop = get_event_loop()
+            await loop.connect_read_pipe(lambda: StreamReaderProtocol(reader), file)
+            while True:
+                data = await reader.read(4096)
+                if not data or not self.feed(data, monotonic()):
+                    break
+        self.release()
+
+
+async def handle_input(game, das=0.167, arr=0.033):
+    def on_action(action, time):
+        if action == "redraw":
+            game.redraw()
+            return
+        if action == "metrics":
+            game.toggle_metrics()
+            return
+        start = perf_counter()
+        game.step(action)
+        if game.metrics is not None:
+            game.metrics.add("input.dispatch", perf_counter() - start)
+        if game.render_scheduler is not None and game.render_scheduler.dirty:
+            game.render_scheduler.mark_input(time)
+
+    await Keyboard(on_action, das, arr).run(stdin)
+
+
+def percentiles(samples, ranks=(50, 99, 100)):
+    ordered = sorted(samples)
+    return [
+        ordered[min(len(ordered) - 1, len(ordered) * rank // 100)] for rank in ranks
+    ]
+
+
+# Sessions are recorded as a compact binary log: a header with the seed and
+# the playfield size, then one varint per step() call holding the
+# milliseconds elapsed since the previous one and the action code in its
+# low 4 bits, then the end code followed by the final score and grid hash.
+recording_magic = b"TTRS\x01"
+recorded_actions = tuple(step_actions)
+recording_end = 0xF
+
+Recording = namedtuple(
+    "Recording", ["seed", "width", "height", "events", "score", "grid_hash"]
+)
+
+
+def write_varint(buffer, value):
+    while value > 0x7F:
+        buffer.append(value & 0x7F | 0x80)
+        value >>= 7
+    buffer.append(value)
+
+
+def read_varint(data, position):
+    value = 0
+    shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, position
+        shift += 7
+
+
+class Recorder:
+    action_codes = {action: code for code, action in enumerate(recorded_actions)}
+
+    def __init__(self, game):
+        self.start = monotonic()
+        self.last_tick = 0
+        self.data = bytearray(recording_magic)
+        # zigzag encoding as seeds can be negative
+        seed = game.bag.seed
+        write_varint(self.data, seed * 2 if seed >= 0 else -seed * 2 - 1)
+        write_varint(self.data, game.width)
+        write_varint(self.data, game.height)
+
+    def record(self, action):
+        tick = int((monotonic() - self.start) * 1000)
+        write_varint(
+            self.data, (tick - self.last_tick) << 4 | self.action_codes[action]
+        )
+        self.last_tick = tick
+
+    def finish(self, game):
+        data = bytearray(self.data)
+        write_varint(data, recording_end)
+        write_varint(data, game.score)
+        data += game.grid_hash()
+        return bytes(data)
+
+
+def load_recording(data):
+    if not data.startswith(recording_magic):
+        raise ValueError("not a tetris.py recording")
+    position = len(recording_magic)
+    seed, position = read_varint(data, position)
+    seed = seed // 2 if seed % 2 == 0 else -(seed + 1) // 2
+    width, position = read_varint(data, position)
+    height, position = read_varint(data, position)
+    events = []
+    tick = 0
+    while True:
+        value, position = read_varint(data, position)
+        code = value & 0xF
+        if code == recording_end:
+            break
+        tick += value >> 4
+        events.append((tick, recorded_actions[code]))
+    score, position = read_varint(data, position)
+    grid_hash = bytes(data[position : position + 8])
+    return Recording(seed, width, height, events, score, grid_hash)
+
+
+def replay(recording, realtime=False):
+    # Plays the recorded actions again as fast as possible, or at the speed
+    # they were recorded while drawing the game, and returns the game
+    grid = [bytes(recording.width)] * recording.height
+    game = Game(grid, headless=not realtime, seed=recording.seed)
+    game.new_tetromino()
+    start = monotonic()
+    for tick, action in recording.events:
+        if realtime:
+            delay = start + tick / 1000 - monotonic()
+            if delay > 0:
+                sleep_blocking(delay)
+        game.step(action)
+    return game
+
+
+def replay_command(args):
+    recording = load_recording(args.file.read())
+    start = perf_counter()
+    try:
+        game = replay(recording, args.realtime)
+    finally:
+        if args.realtime:
+            show_cursor()
+    elapsed = perf_counter() - start
+    grid_matches = game.grid_hash() == recording.grid_hash
+    print(
+        "{} actions replayed in {:.3f}s, score {} (recorded {}), grid {}".format(
+            len(recording.events),
+            elapsed,
+            game.score,
+            recording.score,
+            "matches" if grid_matches else "differs",
+        )
+    )
+    if game.score != recording.score or not grid_matches:
+        raise SystemExit(1)
+
+
+# Picks placements for the current tetromino of a game: every reachable
+# placement is rated with weighted board features, the best `beam_width`
+# ones are searched again with the next tetromino and the best pair wins.
+# The search stops expanding the beam once `budget` seconds are spent.
+class AutoPlayer:
+    weights = {
+        "height": -0.51,
+        "holes": -0.36,
+        "bumpiness": -0.18,
+        "wells": -0.1,
+        "lines": 0.76,
+        "game_over": -1000,
+    }
+
+    def __init__(self, budget=0.05, beam_width=8, weights=None, delay=0):
+        self.budget = budget
+        self.beam_width = beam_width
+        self.delay = delay
+        if weights is not None:
+            self.weights = {**self.weights, **weights}
+
+    def features(self, game, rows):
+        heights, holes, wells, _ = game.compute_surface(rows)
+        bumpiness = sum(abs(a - b) for a, b in zip(heights, heights[1:]))
+        return sum(heights), sum(holes), bumpiness, sum(wells)
+
+    def evaluate(self, game, rows, lines, game_over):
+        height, holes, bumpiness, wells = self.features(game, rows)
+        weights = self.weights
+        return (
+            weights["height"] * height
+            + weights["holes"] * holes
+            + weights["bumpiness"] * bumpiness
+            + weights["wells"] * wells
+            + weights["lines"] * lines
+            + weights["game_over"] * game_over
+        )
+
+    def outcomes(self, game, shape, placements, rows, lines=0):
+        # (value, placement, rows after, lines removed) for each placement
+        outcomes = []
+        bounds = tetromino_bounds[shape]
+        for placement in placements:
+            column, row, rotation = placement[:3]
+            next_rows, lines_removed = game.rows_after(
+                shape, column, row, rotation, rows
+            )
+            lines_removed += lines
+            game_over = row + bounds[rotation][2] >= game.visible_height
+            value = self.evaluate(game, next_rows, lines_removed, game_over)
+            outcomes.append((value, placement, next_rows, lines_removed))
+        return outcomes
+
+    def choose(self, game, budget=None):
+        # The placement to use for the current tetromino, None if there is
+        # none. The budget defaults to self.budget, None means no limit.
+        budget = self.budget if budget is None else budget
+        deadline = None if budget is None else perf_counter() + budget
+        beam = self.outcomes(game, game.current_shape, game.placements(), game.rows)
+        if not beam:
+            return None
+        beam.sort(key=lambda outcome: outcome[0], reverse=True)
+        best_value = best = None
+        for value, placement, rows, lines in beam[: self.beam_width]:
+            if best is not None and deadline is not None and perf_counter() > deadline:
                 break
-            elif ch == b"q":
-                game.game_over = True
-            elif ch == b"p":
-                game.pause()
-            elif ch == b"x":
-                game.rotate(-1)
-            elif ch == b" ":
-                game.hard_drop()
-            elif ch == b"\x1b":
-                q.append(ch)
-            elif q == [b"\x1b"] and ch == b"[":
-                q.append(ch)
-            elif q == [b"\x1b", b"["]:
-                if ch == b"D":
-                    # left
-                    game.move(-1)
-                elif ch == b"C":
-                    # right
-                    game.move(1)
-                elif ch == b"A":
-                    # up
-                    game.rotate(1)
-                elif ch == b"B":
-                    # down
-                    game.move_down(soft_drop=True)
-                q.clear()
-
-
-async def game_loop(game):
+            outcomes = self.outcomes(
+                game,
+                game.next_shape,
+                game.placements(game.next_shape, rows),
+                rows,
+                lines,
+            )
+            # a placement after which the next tetromino can't be placed is
+            # as bad as a game over
+            value = max(
+                (outcome[0] for outcome in outcomes),
+                default=value + self.weights["game_over"],
+            )
+            if best is None or value > best_value:
+                best_value, best = value, placement
+        return best
+
+    async def play(self, game):
+        # Plays the game in real time: each placement is searched within the
+        # budget (and within half of the gravity interval) then its actions
+        # are applied at once, and the loop is given back to the timer and
+        # input tasks for `delay` seconds.
+        from asyncio import sleep
+
+        while not game.game_over:
+            if game.paused:
+                await sleep(0.05)
+                continue
+            budget = game.interval() / 2
+            if self.budget is not None:
+                budget = min(self.budget, budget)
+            placement = self.choose(game, budget)
+            if placement is not None:
+                for action in placement.path:
+                    game.step(action)
+            await sleep(self.delay)
+
+
+async def game_loop(
+    game,
+    fps=60,
+    autoplayer=None,
+    record=None,
+    das=0.167,
+    arr=0.033,
+    show_input_latency=False,
+    metrics=None,
+):
+    from asyncio import create_task
+
+    game.render_scheduler = RenderScheduler(game, fps)
+    if metrics is not None:
+        Metrics(metrics).attach(game)
+    if record is not None:
+        game.recorder = Recorder(game)
     game.new_tetromino()
-    create_task(handle_input(game))
+    create_task(handle_input(game, das, arr))
+    create_task(game.render_scheduler.run())
+    if autoplayer is not None:
+        create_task(autoplayer.play(game))
     try:
-        async for tick in game.timer():
-            game.move_down()
+        async for rows in game.timer():
+            game.fall(rows)
+        game.render_scheduler.stop()
+        game.render_scheduler.flush()
         print("game over, score:", game.score)
+        latencies = game.render_scheduler.input_latencies
+        if show_input_latency and latencies:
+            print(
+                "key to frame latency p50 {:.1f} ms, p99 {:.1f} ms, "
+                "max {:.1f} ms".format(*(t * 1000 for t in percentiles(latencies)))
+            )
     finally:
         show_cursor()
+        if metrics is not None:
+            game.metrics.export()
+            metrics.close()
+        if record is not None:
+            record.write(game.recorder.finish(game))
+            record.close()
+
+
+# Policies choose the actions placing the current tetromino of a headless
+# game, the last one is expected to lock it.
+
+
+def drop_policy(game, rng):
+    return ["hard"]
+
+
+def random_policy(game, rng):
+    return [
+        *rng.choices(("left", "right", "cw", "ccw"), k=rng.randrange(8)),
+        "hard",
+    ]
+
+
+def beam_policy(game, rng):
+    placement = AutoPlayer(budget=None).choose(game)
+    return ["hard"] if placement is None else placement.path
+
+
+policies = {
+    "drop": drop_policy,
+    "random": random_policy,
+    "beam": beam_policy,
+}
+
+GameSummary = namedtuple(
+    "GameSummary", ["seed", "score", "level", "lines", "pieces", "t_spins"]
+)
+
+
+def play_headless(game_seed, policy, max_pieces=None, writer=None):
+    # Each placement is given to the writer (see dataset.py) if there is one
+    rng = Random(game_seed)
+    game = Game(headless=True, seed=game_seed)
+    game.new_tetromino()
+    while not game.game_over and (max_pieces is None or game.pieces < max_pieces):
+        pieces = game.pieces
+        grid, shape, next_shape = game.grid, game.current_shape, game.next_shape
+        score, lines = game.score, game.lines
+        for action in policies[policy](game, rng):
+            column, rotation = game.current_column, game.current_rotation
+            game.step(action)
+            if game.pieces != pieces:
+                break
+        else:
+            # the policy did not lock the tetromino
+            column, rotation = game.current_column, game.current_rotation
+            game.step("hard")
+        if writer is not None:
+            writer.add(
+                grid,
+                shape,
+                next_shape,
+                column,
+                rotation,
+                game.score - score,
+                game.lines - lines,
+            )
+    summary = GameSummary(
+        game_seed, game.score, game.level, game.lines, game.pieces, game.t_spins
+    )
+    if writer is not None:
+        writer.end_game(summary)
+    return summary
+
+
+def play_headless_batch(seeds, policy, max_pieces=None):
+    return [play_headless(game_seed, policy, max_pieces) for game_seed in seeds]
+
+
+def run_batch(policy, games, first_seed=0, workers=None, max_pieces=None):
+    # Yields the summaries of the games played with seeds first_seed to
+    # first_seed + games - 1, as soon as each shard of games is done.
+    workers = workers or cpu_count() or 1
+    shard_size = max(1, min(64, games // (workers * 8)))
+    shards = [
+        (range(start, min(start + shard_size, first_seed + games)), policy, max_pieces)
+        for start in range(first_seed, first_seed + games, shard_size)
+    ]
+    from multiprocessing import Pool
+
+    with Pool(workers) as pool:
+        for summaries in pool.imap_unordered(play_headless_shard, shards):
+            yield from summaries
+
+
+def play_headless_shard(shard):
+    return play_headless_batch(*shard)
+
+
+class BatchStats:
+    def __init__(self):
+        self.games = 0
+        self.pieces = 0
+        self.totals = dict.fromkeys(("score", "level", "lines", "t_spins"), 0)
+        self.best = None
+
+    def add(self, summary):
+        self.games += 1
+        self.pieces += summary.pieces
+        for key in self.totals:
+            self.totals[key] += getattr(summary, key)
+        if self.best is None or summary.score > self.best.score:
+            self.best = summary
+
+    def report(self, elapsed):
+        means = ", ".join(
+            "{} {:.1f}".format(key, total / self.games)
+            for key, total in self.totals.items()
+        )
+        return "{} games, {} pieces/s, mean {}, best score {} (seed {})".format(
+            self.games,
+            round(self.pieces / elapsed),
+            means,
+            self.best.score,
+            self.best.seed,
+        )
+
+
+def batch(args):
+    stats = BatchStats()
+    start = perf_counter()
+    last_report = start
+    for summary in run_batch(
+        args.policy, args.games, args.seed, args.workers, args.max_pieces
+    ):
+        stats.add(summary)
+        if args.output is not None:
+            print(*summary, sep="\t", file=args.output)
+        now = perf_counter()
+        if now - last_report >= 1:
+            last_report = now
+            print(stats.report(now - start), file=stderr)
+    if stats.games:
+        print(stats.report(perf_counter() - start))
+
+
+def main(args=None):
+    from argparse import ArgumentParser, FileType
+
+    parser = ArgumentParser(description="Simple Python Tetris running in a terminal")
+    parser.add_argument(
+        "--fps", type=float, default=60, help="maximum frames drawn per second"
+    )
+    parser.add_argument("--seed", type=int, help="seed of the tetromino generator")
+    parser.add_argument(
+        "--autoplay", action="store_true", help="let the computer play the game"
+    )
+    parser.add_argument(
+        "--autoplay-budget",
+        type=float,
+        default=50,
+        help="milliseconds the computer spends searching for each placement",
+    )
+    parser.add_argument(
+        "--autoplay-delay",
+        type=float,
+        default=0.2,
+        help="seconds the computer waits between placements",
+    )
+    parser.add_argument(
+        "--record", type=FileType("wb"), help="record the session in this file"
+    )
+    parser.add_argument(
+        "--das",
+        type=float,
+        default=167,
+        help="milliseconds a key is held before it repeats",
+    )
+    parser.add_argument(
+        "--arr",
+        type=float,
+        default=33,
+        help="milliseconds between the repeats of a held key, 0 is instant",
+    )
+    parser.add_argument(
+        "--metrics",
+        type=FileType("w"),
+        help="time the game phases and write their percentiles in this JSON file "
+        "on exit, m shows them",
+    )
+    parser.add_argument(
+        "--input-latency",
+        action="store_true",
+        help="print the latency from key presses to frames on exit",
+    )
+    commands = parser.add_subparsers(dest="command")
+    replay_parser = commands.add_parser(
+        "replay", help="replay a recorded session and check its outcome"
+    )
+    replay_parser.add_argument("file", type=FileType("rb"))
+    replay_parser.add_argument(
+        "--realtime", action="store_true", help="replay at the recorded speed"
+    )
+    batch_parser = commands.add_parser(
+        "batch", help="play many headless games in parallel"
+    )
+    batch_parser.add_argument("--policy", choices=policies, default="random")
+    batch_parser.add_argument("--games", type=int, default=1000)
+    batch_parser.add_argument("--seed", type=int, default=0, help="first seed")
+    batch_parser.add_argument(
+        "--workers", type=int, help="worker processes, defaults to the CPU count"
+    )
+    batch_parser.add_argument(
+        "--max-pieces", type=int, help="stop each game after this many pieces"
+    )
+    batch_parser.add_argument(
+        "--output",
+        type=FileType("w"),
+        help="write a tab separated summary of each game to this file",
+    )
+    export_parser = commands.add_parser(
+        "export", help="write the placements of headless games as training data"
+    )
+    export_parser.add_argument("directory")
+    export_parser.add_argument("--policy", choices=policies, default="random")
+    export_parser.add_argument("--games", type=int, default=1000)
+    export_parser.add_argument("--seed", type=int, default=0, help="first seed")
+    export_parser.add_argument(
+        "--max-pieces", type=int, help="stop each game after this many pieces"
+    )
+    export_parser.add_argument(
+        "--chunk-size", type=int, default=65536, help="samples per .npy file"
+    )
+    export_parser.add_argument(
+        "--bitplanes", action="store_true", help="store one bit per cell"
+    )
+    serve_parser = commands.add_parser("serve", help="host multiplayer games over TCP")
+    serve_parser.add_argument("--host", default="127.0.0.1")
+    serve_parser.add_argument("--port", type=int, default=7777)
+    serve_parser.add_argument(
+        "--fps", type=float, default=30, help="maximum frames sent per second"
+    )
+    connect_parser = commands.add_parser("connect", help="play on a server")
+    connect_parser.add_argument("--host", default="127.0.0.1")
+    connect_parser.add_argument("--port", type=int, default=7777)
+    connect_parser.add_argument(
+        "--versus", action="store_true", help="play against another player"
+    )
+    connect_parser.add_argument(
+        "--watch", type=int, metavar="GAME_ID", help="watch the game with this id"
+    )
+    loadgen_parser = commands.add_parser(
+        "loadgen", help="play many random games on a server"
+    )
+    loadgen_parser.add_argument("--host", default="127.0.0.1")
+    loadgen_parser.add_argument("--port", type=int, default=7777)
+    loadgen_parser.add_argument("--sessions", type=int, default=1000)
+    loadgen_parser.add_argument(
+        "--rate", type=float, default=5, help="actions per second of each session"
+    )
+    loadgen_parser.add_argument(
+        "--duration", type=float, default=10, help="seconds before disconnecting"
+    )
+    loadgen_parser.add_argument("--versus", action="store_true")
+    loadgen_parser.add_argument(
+        "--spectators", type=int, default=0, help="spectators watching each game"
+    )
+    loadgen_parser.add_argument("--seed", type=int)
+    args = parser.parse_args(args)
+    if args.command in ("serve", "connect", "loadgen"):
+        # imported here as the server module imports this one
+        import server
+
+        getattr(server, args.command + "_command")(args)
+        return
+    if args.command == "batch":
+        batch(args)
+        return
+    if args.command == "export":
+        # imported here as it needs numpy
+        import dataset
+
+        dataset.export_command(args)
+        return
+    if args.command == "replay":
+        replay_command(args)
+        return
+    autoplayer = None
+    if args.autoplay:
+        autoplayer = AutoPlayer(
+            budget=args.autoplay_budget / 1000, delay=args.autoplay_delay
+        )
+    from asyncio import run
+
+    game = Game(seed=args.seed)
+    run(
+        game_loop(
+            game,
+            args.fps,
+            autoplayer,
+            args.record,
+            args.das / 1000,
+            args.arr / 1000,
+            args.input_latency,
+            args.metrics,
+        )
+    )
 
 
 if __name__ == "__main__":
-    game = Game()
-    run(game_loop(game))
+    main()
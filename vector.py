@@ -0,0 +1,434 @@
+# Many headless games stepped in lockstep with NumPy, needs numpy.
+#
+# VectorGame holds the grids of N games in one (N, height, width) array of
+# piece codes, and the rest of their state in arrays of N values named like
+# the attributes of Game. step() takes one action per game, as indexes in
+# recorded_actions, and applies them with array operations: collisions are
+# tested by gathering the cells under the tetrominoes, complete lines are the
+# rows without empty cells and scores are looked up in tables built from
+# points, t_spin_points and mini_t_spin_points. The games play exactly like
+# Game.step with the same seeds and actions, without garbage.
+#
+# The arrays are the observations: they are updated in place and never
+# copied, games over are left as they are until reset().
+
+import numpy as np
+
+from tetris import (
+    StepResult,
+    bag_order,
+    bag_orders,
+    kick_table,
+    mask64,
+    mini_t_spin_points,
+    points,
+    recorded_actions,
+    shapes,
+    t_spin_points,
+    tetromino_bounds,
+    tetromino_cells,
+    tetromino_columns,
+    tetromino_width,
+)
+
+LEFT, RIGHT, CW, CCW, SOFT, HARD, GRAVITY, PAUSE, QUIT = (
+    recorded_actions.index(action)
+    for action in ("left", "right", "cw", "ccw", "soft", "hard", "gravity")
+    + ("pause", "quit")
+)
+
+# last_movement codes
+MOVE, ROTATE, DOWN = 1, 2, 3
+
+# Tables of the orientations of the tetrominoes, indexed by 4 * shape index
+# (the piece code minus 1) + rotation and looked up with take(), much faster
+# than indexing with two arrays
+orientations = [(shape, rotation) for shape in shapes for rotation in range(4)]
+cell_rows = np.array(
+    [
+        [i for i, j in tetromino_cells[shape][rotation]]
+        for shape, rotation in orientations
+    ]
+)
+cell_columns = np.array(
+    [
+        [j for i, j in tetromino_cells[shape][rotation]]
+        for shape, rotation in orientations
+    ]
+)
+# whether each cell is the first of its row
+row_firsts = np.array(
+    [
+        [
+            i not in [other for other, _ in tetromino_cells[shape][rotation][:n]]
+            for n, (i, j) in enumerate(tetromino_cells[shape][rotation])
+        ]
+        for shape, rotation in orientations
+    ]
+)
+# (column offset, lowest row offset, highest row offset + 1) of the columns
+# of the tetrominoes, repeating the last one up to 4 columns
+column_offsets, column_bottoms, column_tops = (
+    np.array(
+        [
+            [columns[min(n, len(columns) - 1)][field] + (field == 2) for n in range(4)]
+            for columns in (
+                tetromino_columns[shape][rotation] for shape, rotation in orientations
+            )
+        ]
+    )
+    for field in range(3)
+)
+min_rows, max_rows = (
+    np.array(
+        [tetromino_bounds[shape][rotation][field] for shape, rotation in orientations]
+    )
+    for field in (0, 2)
+)
+widths = np.array([tetromino_width(shape) for shape in shapes])
+o_shape = shapes.index("o")
+# (column, row) offsets of the wall kicks after the first one (always (0,
+# 0)), by 2 * orientation + direction (0 for cw, 1 for ccw), the o
+# tetromino never rotates
+kicks = np.zeros((len(orientations) * 2, 4, 2), int)
+for (shape, rotation, next_rotation), shape_kicks in kick_table.items():
+    direction = 0 if next_rotation == (rotation + 1) % 4 else 1
+    kicks[orientations.index((shape, rotation)) * 2 + direction] = shape_kicks[1:]
+
+# points by spin kind (see spin_kinds) and lines removed
+spin_points = np.array(
+    [
+        [table.get(lines, 0) for lines in range(5)]
+        for table in (points, mini_t_spin_points, t_spin_points)
+    ]
+)
+bag_permutations = np.array([bag_order(order) for order in range(bag_orders)], "u1")
+
+# column, row and rotation deltas of the actions moving the tetromino
+action_columns = np.zeros(len(recorded_actions), int)
+action_columns[[LEFT, RIGHT]] = -1, 1
+action_rows = np.zeros(len(recorded_actions), int)
+action_rows[[SOFT, GRAVITY]] = -1
+action_rotations = np.zeros(len(recorded_actions), int)
+action_rotations[[CW, CCW]] = 1, -1
+movements = np.zeros(len(recorded_actions), "u1")
+movements[[LEFT, RIGHT, CW, CCW, SOFT, GRAVITY]] = (
+    MOVE,
+    MOVE,
+    ROTATE,
+    ROTATE,
+    DOWN,
+    DOWN,
+)
+# t-spin corners around the tetromino position
+corner_rows = np.array([0, 0, 2, 2])
+corner_columns = np.array([0, 2, 0, 2])
+
+# Cells around the grids in VectorGame.board, the walls and the floor are
+# filled with wall_code so that tetrominoes out of bounds collide with them
+# like with locked cells, up to the farthest wall kick. The right wall is
+# wider so that board rows are made of whole 64 bits words.
+padding = 2
+wall_code = 0xFF
+
+# NumPy reductions along short axes are slow, the 4 cells of a tetromino are
+# tested at once as a 32 bits word and whole rows as 64 bits words of bools
+cell_ones = np.uint32(0x01010101)
+row_ones = np.uint64(0x0101010101010101)
+
+
+def count_cells(cells):
+    # The number of true values in each line of a (n, 4) array of bools
+    return (cells.view(np.uint32)[:, 0] * cell_ones) >> np.uint32(24)
+
+
+# Bag's splitmix64 states only grow by a constant, so the games draw several
+# bags at once from their state
+bags_drawn = 8
+splitmix_steps = np.uint64(0x9E3779B97F4A7C15) * np.arange(
+    1, bags_drawn + 1, dtype=np.uint64
+)
+
+
+def splitmix64(states):
+    # The random numbers of Bag's splitmix64 for an array of states, uint64
+    # operations wrap around
+    z = states
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return z ^ (z >> np.uint64(31))
+
+
+class VectorGame:
+    def __init__(self, seeds, grid=None, width=10, visible_height=20):
+        # grid is the starting grid of every game, empty by default
+        self.size = len(seeds)
+        if grid is None:
+            self.width = width
+            self.visible_height = visible_height
+            self.height = visible_height * 2
+            grid = np.zeros((self.height, width), "u1")
+        else:
+            grid = np.array([list(line) for line in grid], "u1")
+            self.height, self.width = grid.shape
+            self.visible_height = self.height // 2
+        board_height = self.height + 2 * padding
+        self.board_width = -(-(self.width + 2 * padding) // 8) * 8
+        self.start_board = np.full((board_height, self.board_width), wall_code, "u1")
+        columns = slice(padding, padding + self.width)
+        self.start_board[padding:, columns] = 0
+        self.start_board[padding : padding + self.height, columns] = grid
+        self.board = np.empty((self.size, *self.start_board.shape), "u1")
+        # The grids are a view of the boards, the cells of the boards are
+        # indexed in one dimension by game * board_cells + row * board_width
+        # + column from the bottom left cell of the grid.
+        self.grid = self.board[:, padding : padding + self.height, columns]
+        # the height of each column of the grids, the row above its top cell
+        self.heights = np.zeros((self.size, self.width), int)
+        self.flat_heights = self.heights.reshape(-1)
+        self.cells = self.board.reshape(-1)
+        self.board_cells = self.start_board.size
+        # NumPy gathers faster with take() along one dimension, the rows of the
+        # boards and the heights of the columns are also flattened
+        self.board_rows = self.board.reshape(-1, self.board_width)
+        self.origin = padding * self.board_width + padding
+        self.cell_offsets = cell_rows * self.board_width + cell_columns
+        self.corner_offsets = corner_rows * self.board_width + corner_columns
+        self.row_index = np.arange(board_height) - padding
+        self.games = np.arange(self.size)
+        # the grid row right above each board row, plus padding
+        self.row_tops = np.arange(1, board_height + 1, dtype="u1")
+        self.start_heights = self.column_heights(grid[None])[0]
+        self.current_shape = np.zeros(self.size, "u1")
+        self.next_shape = np.zeros(self.size, "u1")
+        self.current_column = np.zeros(self.size, int)
+        self.current_row = np.zeros(self.size, int)
+        self.current_rotation = np.zeros(self.size, int)
+        self.last_movement = np.zeros(self.size, "u1")
+        self.wall_kicked = np.zeros(self.size, bool)
+        self.score = np.zeros(self.size, int)
+        self.level = np.zeros(self.size, int)
+        self.lines = np.zeros(self.size, int)
+        self.pieces = np.zeros(self.size, int)
+        self.t_spins = np.zeros(self.size, int)
+        self.paused = np.zeros(self.size, bool)
+        self.game_over = np.zeros(self.size, bool)
+        self.bag_state = np.zeros(self.size, np.uint64)
+        self.bag = np.zeros((self.size, bags_drawn * len(shapes)), "u1")
+        self.bag_position = np.zeros(self.size, int)
+        self.reset(self.games, seeds)
+
+    def reset(self, games, seeds):
+        # Restarts the given games with new seeds
+        games = np.asarray(games)
+        self.board[games] = self.start_board
+        self.heights[games] = self.start_heights
+        self.last_movement[games] = 0
+        self.wall_kicked[games] = False
+        self.score[games] = 0
+        self.level[games] = 1
+        for field in (self.lines, self.pieces, self.t_spins):
+            field[games] = 0
+        self.paused[games] = False
+        self.game_over[games] = False
+        self.bag_state[games] = np.array(
+            [int(seed) & mask64 for seed in seeds], np.uint64
+        )
+        self.bag_position[games] = self.bag.shape[1]
+        self.next_shape[games] = self.next_pieces(games)
+        self.new_tetrominoes(games)
+
+    def next_pieces(self, games):
+        # Shape indexes drawn from the bags of the games, one per game
+        empty = games[self.bag_position[games] == self.bag.shape[1]]
+        if len(empty):
+            states = self.bag_state[empty, None] + splitmix_steps
+            self.bag_state[empty] = states[:, -1]
+            orders = splitmix64(states) % np.uint64(bag_orders)
+            self.bag[empty] = bag_permutations[orders].reshape(len(empty), -1)
+            self.bag_position[empty] = 0
+        pieces = self.bag[games, self.bag_position[games]]
+        self.bag_position[games] += 1
+        return pieces
+
+    def new_tetrominoes(self, games):
+        shape = self.current_shape[games] = self.next_shape[games]
+        self.next_shape[games] = self.next_pieces(games)
+        self.current_column[games] = (self.width - widths[shape]) // 2
+        self.current_row[games] = self.visible_height
+        self.current_rotation[games] = 0
+
+    def orientations(self, games):
+        return self.current_shape[games] * 4 + self.current_rotation[games]
+
+    def positions(self, games, column, row):
+        # Index in self.cells of the position of the tetrominoes
+        return games * self.board_cells + row * self.board_width + column + self.origin
+
+    def tetrominoes_fit(self, games, orientation, column, row):
+        cells = self.positions(games, column, row)[:, None]
+        cells = self.cells.take(cells + self.cell_offsets.take(orientation, 0))
+        return cells.view(np.uint32)[:, 0] == 0
+
+    def column_heights(self, grids):
+        return ((grids != 0) * self.row_tops[: self.height, None]).max(1)
+
+    def drop_distances(self, games):
+        # How many rows each tetromino can fall: like Game.get_ghost_row the
+        # column heights tell where it lands unless it is below the top of a
+        # column, under an overhang
+        orientation = self.orientations(games)
+        columns = self.current_column[games] + games * self.width
+        columns = columns[:, None] + column_offsets.take(orientation, 0)
+        heights = self.flat_heights.take(columns)
+        ghost_rows = (heights - column_bottoms.take(orientation, 0)).max(1)
+        rows = self.current_row[games]
+        under = ghost_rows > rows
+        if under.any():
+            ghost_rows[under] = rows[under] - self.fall_distances(games[under])
+        return rows - ghost_rows
+
+    def fall_distances(self, games):
+        # How many rows each tetromino can fall, from the highest filled cell
+        # (or floor) below each of its cells
+        orientation = self.orientations(games)
+        rows = self.current_row[games, None] + cell_rows.take(orientation, 0)
+        columns = self.current_column[games, None] + cell_columns.take(orientation, 0)
+        filled = self.board[games[:, None], :, columns + padding] != 0
+        below = filled & (self.row_index < rows[:, :, None])
+        tops = (below * self.row_tops).max(2).astype(int) - padding
+        return (rows - tops).min(1)
+
+    def step(self, actions):
+        # Applies one action to each game, games over are left as they are.
+        # Returns a StepResult of arrays, t_spin being indexes in spin_kinds.
+        actions = np.asarray(actions)
+        score = self.score.copy()
+        self.lines_cleared = np.zeros(self.size, int)
+        self.last_t_spin = np.zeros(self.size, int)
+        playing = ~self.game_over
+        self.paused ^= playing & (actions == PAUSE)
+        self.game_over |= playing & (actions == QUIT)
+        playing &= ~self.paused & (actions < PAUSE)
+        dropping = playing & (actions == HARD)
+        locked = self.move(playing & ~dropping, actions)
+        dropped = np.flatnonzero(dropping)
+        self.hard_drop(dropped)
+        self.lock(np.concatenate([locked, dropped]))
+        return StepResult(
+            self.lines_cleared,
+            self.last_t_spin,
+            self.score - score,
+            self.game_over.copy(),
+        )
+
+    def move(self, moving, actions):
+        # Moves left, right, down or rotates the tetrominoes of the moving
+        # games, returns the games where they lock. The first wall kick of the
+        # rotations is (0, 0) so they are first tried with the moves. Most
+        # games move at each step so this works on whole arrays.
+        columns = action_columns[actions]
+        rows = action_rows[actions]
+        rotations = action_rotations[actions]
+        # the o tetromino doesn't rotate
+        rotating = moving & (rotations != 0)
+        rotating &= self.current_shape != o_shape
+        moving &= (rotations == 0) | rotating
+        next_rotation = (self.current_rotation + rotations) % 4
+        fit = moving & self.tetrominoes_fit(
+            self.games,
+            self.current_shape * 4 + next_rotation,
+            self.current_column + columns,
+            self.current_row + rows,
+        )
+        self.current_column += columns * fit
+        self.current_row += rows * fit
+        np.copyto(self.current_rotation, next_rotation, where=fit)
+        np.copyto(self.last_movement, movements.take(actions), where=fit)
+        self.score += fit & (actions == SOFT)
+        # like in Game the rotations remember whether they were kicked even
+        # when none fits
+        np.copyto(self.wall_kicked, ~fit, where=rotating)
+        kicked = np.flatnonzero(rotating & ~fit)
+        self.kick(kicked, rotations[kicked])
+        return np.flatnonzero(moving & ~fit & (rows != 0))
+
+    def kick(self, games, rotations):
+        # Tries the following wall kicks of the rotations that didn't fit,
+        # all at once
+        orientation = self.orientations(games)
+        next_rotation = (self.current_rotation[games] + rotations) % 4
+        shape_kicks = kicks.take(orientation * 2 + (rotations < 0), 0)
+        columns = self.current_column[games, None] + shape_kicks[:, :, 0]
+        rows = self.current_row[games, None] + shape_kicks[:, :, 1]
+        positions = self.positions(games[:, None], columns, rows)[:, :, None]
+        offsets = self.cell_offsets.take(
+            orientation - orientation % 4 + next_rotation, 0
+        )
+        cells = self.cells.take(positions + offsets[:, None])
+        fit = cells.view(np.uint32)[:, :, 0] == 0
+        rotated = fit.any(1)
+        kick = fit.argmax(1)[rotated]
+        games = games[rotated]
+        self.current_column[games] = columns[rotated, kick]
+        self.current_row[games] = rows[rotated, kick]
+        self.current_rotation[games] = next_rotation[rotated]
+        self.last_movement[games] = ROTATE
+
+    def hard_drop(self, games):
+        distances = self.drop_distances(games)
+        self.current_row[games] -= distances
+        self.score[games] += 2 * distances
+        self.last_movement[games[distances > 0]] = DOWN
+
+    def lock(self, games):
+        if not len(games):
+            return
+        shape = self.current_shape[games]
+        orientation = self.orientations(games)
+        row = self.current_row[games]
+        positions = self.positions(games, self.current_column[games], row)[:, None]
+        # the t-spin corners are checked for every shape, as in Game
+        corners = count_cells(self.cells.take(positions + self.corner_offsets) != 0)
+        spins = (self.last_movement[games] == ROTATE) & (corners >= 3)
+        spin = np.where(spins, np.where(self.wall_kicked[games], 1, 2), 0)
+        cells = positions + self.cell_offsets.take(orientation, 0)
+        self.cells[cells] = (shape + 1)[:, None]
+        columns = self.current_column[games] + games * self.width
+        columns = columns[:, None] + column_offsets.take(orientation, 0)
+        tops = row[:, None] + column_tops.take(orientation, 0)
+        self.flat_heights[columns] = np.maximum(self.flat_heights.take(columns), tops)
+        rows = row[:, None] + cell_rows.take(orientation, 0)
+        board_rows = rows + games[:, None] * (self.height + 2 * padding) + padding
+        filled = self.board_rows.take(board_rows, 0) != 0
+        complete = np.bitwise_and.reduce(filled.view(np.uint64), 2) == row_ones
+        lines = count_cells(complete & row_firsts.take(orientation, 0)).astype(int)
+        clearing = lines > 0
+        if clearing.any():
+            self.remove_lines(games[clearing], rows[clearing], complete[clearing])
+        self.lines_cleared[games] = lines
+        self.last_t_spin[games] = spin
+        self.lines[games] += lines
+        self.score[games] += spin_points[spin, lines] * self.level[games]
+        # level_goal of the levels
+        level = self.level[games]
+        self.level[games] += self.score[games] >= level * (level + 1) // 2 * 500
+        self.pieces[games] += 1
+        self.t_spins[games] += spin > 0
+        # tetrominoes have no empty line between their bottom and top cells
+        top = self.visible_height - row
+        self.game_over[games] |= (min_rows.take(orientation) <= top) & (
+            top <= max_rows.take(orientation)
+        )
+        self.new_tetrominoes(games)
+
+    def remove_lines(self, games, rows, complete):
+        # The kept rows move down in order and empty rows fill the top
+        removed = np.zeros((len(games), self.height), bool)
+        removed[np.arange(len(games))[:, None], rows] = complete
+        lines = removed.sum(1)
+        order = np.argsort(removed, axis=1, kind="stable")
+        grids = np.take_along_axis(self.grid[games], order[:, :, None], 1)
+        grids[np.arange(self.height) >= self.height - lines[:, None]] = 0
+        self.grid[games] = grids
+        self.heights[games] = self.column_heights(grids)